@@ -1,12 +1,141 @@
 # packages
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import threading
 from datetime import datetime
+import glob
+import json
+import os
+import random
+import tempfile
 import time
+from lib_class_Metrics import metrics
+from lib_class_other import Clock, changed_keys, check_config
+from lib_class_Transport import CircuitBreaker, CircuitOpenError, Transport, endpoint_name
 
 
 # defs
+# Forecast from the meteo API is a list of timestamps and a list of values, in 6-hour slots. It's parsed once, right
+# after it's received, into a trajectory: values linearly interpolated between the slots, precomputed with fixed
+# time step over the whole forecast horizon. Looking up the value at any moment is then just an array index.
+def build_trajectory(forecast: dict, offset=0.0, step=60.0):
+    if "times" not in forecast.keys() or len(forecast["times"]) == 0:
+        return None
+    times = [datetime.strptime(timestamp[0:16], "%Y-%m-%dT%H:%M").timestamp() for timestamp in forecast["times"]]
+    data = [float(value) + offset for value in forecast["data"]]
+    values = []
+    segment = 0
+    for index in range(int((times[-1] - times[0]) // step) + 1):
+        moment = times[0] + index * step
+        while segment < len(times) - 2 and moment >= times[segment + 1]:
+            segment = segment + 1
+        if len(times) == 1:
+            values.append(data[0])
+        else:
+            share = (moment - times[segment]) / (times[segment + 1] - times[segment])
+            values.append(data[segment] + share * (data[segment + 1] - data[segment]))
+    return {"start": times[0], "step": step, "values": values}
+
+
+# Before the start of the forecast the first value is held and after the end - the last one. No data gives 0.0.
+def trajectory_value(trajectory, timestamp: float) -> float:
+    if trajectory is None:
+        return 0.0
+    index = int((timestamp - trajectory["start"]) // trajectory["step"])
+    if index < 0:
+        index = 0
+    elif index >= len(trajectory["values"]):
+        index = len(trajectory["values"]) - 1
+    return trajectory["values"][index]
+
+
+# Forecast fields, as named in the configuration (<name>_field, <name>_level), with the key of the resulting
+# trajectory and the offset applied to the values (the temperature comes in Kelvins).
+FORECAST_FIELDS = {"temperature": ("temp", -273.0),
+                   "precipitation": ("preci", 0.0),
+                   "solar_radiation": ("solar", 0.0)}
+
+
+# Entries of ambient_apis.txt needed to ask the meteo API and GIOS, all of them texts.
+AMBIENT_KEYS = ("meteo_url", "api", "model", "grid", "latitude", "longitude", "meteo_api_key", "gios_url", "pm10_id")
+
+
+# Full check of ambient_apis.txt, for reloading it in a running simulator.
+def check_ambient_config(config: dict, config_path="") -> bool:
+    fields = tuple(name + suffix for name in FORECAST_FIELDS for suffix in ("_field", "_level"))
+    return check_config(config, (), config_path, text=AMBIENT_KEYS + fields)
+
+
+# Persistent cache of the data received from the outside APIs, one JSON file per entry. Thanks to it, a restarted
+# simulator serves valid weather immediately and only refreshes what has expired. Age of the entries is measured
+# with the wall clock, because it describes the data from the APIs, not the simulation.
+class AmbientCache(object):
+    def __init__(self, cache_dir="ambient_cache"):
+        self.__cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def cache_dir(self):
+        return self.__cache_dir
+
+    # Entry names are built from the parts of the key, e.g. model, grid, coordinates, field, level and run date.
+    def path(self, key_parts: list) -> str:
+        name = "_".join(str(part) for part in key_parts)
+        for character in "/\\:*?<>| ":
+            name = name.replace(character, "-")
+        return os.path.join(self.__cache_dir, name + ".json")
+
+    # New entry is written aside and renamed, so a crash never leaves a broken file behind. Every writer has its own
+    # temporary file, so threads and processes sharing the cache_dir can store the same entry at once - the last
+    # rename wins. A failure is only reported: the data was already received, losing the cached copy doesn't matter.
+    def store(self, key_parts: list, data) -> bool:
+        path = self.path(key_parts)
+        temp_path = None
+        try:
+            handle, temp_path = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path), dir=self.__cache_dir)
+            cache_file = os.fdopen(handle, mode="w")
+            json.dump({"stored": time.time(), "data": data}, cache_file)
+            cache_file.close()
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as exception:
+            print("{} ; {}".format({"error": "cache_store"}, exception))
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
+
+    def load(self, key_parts: list, ttl: float):
+        return self.load_path(self.path(key_parts), ttl)
+
+    @staticmethod
+    def load_path(path: str, ttl: float):
+        try:
+            cache_file = open(path, mode="r")
+            entry = json.load(cache_file)
+            cache_file.close()
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["stored"] > ttl:
+            return None
+        return entry["data"]
+
+    # The newest valid entry among those whose key starts with given parts - e.g. the latest model run of a field.
+    def latest(self, key_parts: list, ttl: float):
+        prefix = self.path(key_parts)[0:-5]
+        for path in sorted(glob.glob(glob.escape(prefix) + "_*.json"), reverse=True):
+            data = self.load_path(path, ttl)
+            if data is not None:
+                return data
+        return None
+
+
 class Ambient(object):
-    def __init__(self, config_path="ambient_apis.txt"):
+    # site - name of the site, which labels the breakers of the APIs in the metrics (multi-site simulator)
+    def __init__(self, config_path="ambient_apis.txt", clock=None, site=""):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
+        self.__site = site
         self.__config_path = config_path
         self.__config = {}
         # meteo_url  / List of fields available/expected in TXT configuration.
@@ -25,14 +154,29 @@ class Ambient(object):
         # gios_url
         # location_id
         # pm10_id
+        # trajectory_step=(60)   Optional, time resolution of the precomputed forecast trajectories [s].
+        # retry_backoff=(0.25)   Optional, delay before the 1st retry of a forecast request [s], doubled every retry
+        #                        and shortened by a random part (jitter).
+        # breaker_failures=(3)   Optional, circuit breakers of the meteo API and of GIOS: after that many failed
+        # breaker_delay=(5)      requests in a row the API isn't asked at all (error get_..._open) and the cached
+        # breaker_max_delay=(600)  data is used. It's probed again after breaker_delay [s], doubled after every
+        #                          failed probe up to breaker_max_delay.
+        # cache_dir=ambient_cache   Optional, directory of the on-disk cache, empty value turns the cache off.
+        # cache_forecast_ttl=(21600)   Optional, how long cached data stays valid [s]. Forecast is renewed every
+        # cache_dust_ttl=(3600)   6 hours, dust measures every hour and grid coordinates don't change at all.
+        # cache_coordinates_ttl=(2592000)
         self.__meteo_headers = {}
         self.__meteo_coordinates = ""
         self.__meteo_date = ""
-        self.__temperature = {}
-        self.__precipitation = {}
-        self.__solar_radiation = {}
+        # Forecasts and dust measures can be renewed by a background thread (see AmbientFetcher), therefore new data
+        # is always prepared aside and swapped in with a single assignment. Readers never see half-updated data.
+        self.__forecast = {"temperature": {}, "precipitation": {}, "solar_radiation": {}}
+        self.__trajectory = {"temp": None, "preci": None, "solar": None}
         self.__dust_measure = {}
         self.__current = {"temp": 0.0, "preci": 0.0, "solar": 0.0, "dust": 0.0}
+        self.__cache = None
+        self.__meteo_transport = None
+        self.__gios_transport = None
 
     @property
     def config_path(self):
@@ -44,13 +188,105 @@ class Ambient(object):
 
     @config.setter
     def config(self, config: dict):
+        changed = changed_keys(self.__config, config)
         self.__config = config
+        self.__cache = None
+        # Changes made while running: a new API key goes into the headers at once, a new location is resolved by the
+        # next renew_forecast(). Sites subscribed to the WeatherService move to the cell of their new location then.
+        if "meteo_api_key" in changed and "Authorization" in self.__meteo_headers.keys():
+            self.create_meteo_headers()
+        if len(changed & {"model", "grid", "latitude", "longitude"}) > 0 and self.__meteo_coordinates != "":
+            self.__meteo_coordinates = ""
+        if len(changed & {"meteo_url", "breaker_failures", "breaker_delay", "breaker_max_delay"}) > 0:
+            self.__meteo_transport = None
+        if len(changed & {"gios_url", "breaker_failures", "breaker_delay", "breaker_max_delay"}) > 0:
+            self.__gios_transport = None
+
+    # On-disk cache, created on first use. None when it's turned off in the configuration.
+    @property
+    def cache(self):
+        if self.__cache is None and self.__config.get("cache_dir", "ambient_cache") != "":
+            self.__cache = AmbientCache(self.__config.get("cache_dir", "ambient_cache"))
+        return self.__cache
+
+    def create_transport(self, url: str, pool_maxsize=1):
+        breaker = CircuitBreaker(endpoint_name(url), int(self.__config.get("breaker_failures", 3)),
+                                 self.__config.get("breaker_delay", 5.0), self.__config.get("breaker_max_delay", 600.0),
+                                 site=self.__site)
+        return Transport(pool_maxsize=pool_maxsize, breaker=breaker)
+
+    # Sessions of the meteo API (the forecast fields are fetched by 3 threads at once) and of GIOS, created on first
+    # use. Each of them has its own circuit breaker.
+    @property
+    def meteo_transport(self):
+        if self.__meteo_transport is None:
+            self.__meteo_transport = self.create_transport(self.__config["meteo_url"], 3)
+        return self.__meteo_transport
+
+    @property
+    def gios_transport(self):
+        if self.__gios_transport is None:
+            self.__gios_transport = self.create_transport(self.__config["gios_url"])
+        return self.__gios_transport
+
+    @property
+    def meteo_coordinates(self):
+        return self.__meteo_coordinates
+
+    @meteo_coordinates.setter
+    def meteo_coordinates(self, meteo_coordinates: str):
+        self.__meteo_coordinates = meteo_coordinates
+
+    # Forecasts with their trajectories and dust measures, as one object. It's what WeatherService shares between
+    # the sites - the contents are never modified once swapped in, so the same data can be given to many sites.
+    @property
+    def weather(self):
+        return {"forecast": self.__forecast, "trajectory": self.__trajectory, "dust": self.__dust_measure}
+
+    @property
+    def dust_measure(self):
+        return self.__dust_measure
+
+    @dust_measure.setter
+    def dust_measure(self, dust_measure: dict):
+        self.__dust_measure = dust_measure
+
+    def share_forecast(self, weather: dict) -> bool:
+        self.__forecast = weather["forecast"]
+        self.__trajectory = weather["trajectory"]
+        return True
+
+    # Sites with the same location key need the grid coordinates resolved only once.
+    def location_key(self) -> tuple:
+        return (self.__config["meteo_url"], self.__config["api"], self.__config["model"], self.__config["grid"],
+                self.__config["latitude"], self.__config["longitude"])
+
+    # Sites with the same cell key receive exactly the same forecasts.
+    def cell_key(self) -> tuple:
+        fields = tuple((self.__config[name + "_field"], self.__config[name + "_level"]) for name in FORECAST_FIELDS)
+        return (self.__config["meteo_url"], self.__config["api"], self.__config["model"], self.__config["grid"],
+                self.__meteo_coordinates, fields, self.__config.get("trajectory_step", 60.0))
+
+    # Sites with the same station key receive exactly the same dust measures.
+    def station_key(self) -> tuple:
+        return (self.__config["gios_url"], self.__config["pm10_id"])
+
+    def forecast_key(self, name: str) -> list:
+        return ["forecast", self.__config["model"], self.__config["grid"], self.__meteo_coordinates,
+                self.__config[name + "_field"], self.__config[name + "_level"]]
 
     def create_meteo_headers(self):
         self.__meteo_headers.update({"Authorization": "Token {}".format(self.__config["meteo_api_key"])})
         return True
 
     def get_coordinates(self):
+        coordinates_key = ["coordinates", self.__config["model"], self.__config["grid"],
+                           self.__config["latitude"], self.__config["longitude"]]
+        if self.cache is not None:
+            cached = self.cache.load(coordinates_key, self.__config.get("cache_coordinates_ttl", 2592000.0))
+            if cached is not None:
+                self.__meteo_coordinates = cached
+                return {"error": "NONE"}
         coordinates_url = "{}/api/{}/model/{}/grid/{}/latlon2rowcol/{},{}".format(
             self.__config["meteo_url"],
             self.__config["api"],
@@ -59,10 +295,12 @@ class Ambient(object):
             self.__config["latitude"],
             self.__config["longitude"])
         try:
-            coordinates = requests.get(
+            coordinates = self.meteo_transport.get(
                 coordinates_url,
                 headers=self.__meteo_headers,
                 timeout=1.000)
+        except CircuitOpenError:
+            status = {"error": "get_coor_open"}
         except requests.Timeout:
             status = {"error": "get_coor_tout"}
         except requests.ConnectionError:
@@ -74,9 +312,12 @@ class Ambient(object):
                 row = coordinates.json()["points"][0]["row"]
                 col = coordinates.json()["points"][0]["col"]
                 self.__meteo_coordinates = "{},{}".format(row, col)
+                if self.cache is not None:
+                    self.cache.store(coordinates_key, self.__meteo_coordinates)
                 status = {"error": "NONE"}
             else:
                 status = {"error": "get_coor_" + str(coordinates.status_code)}
+        metrics.count_error(status["error"])
         return status
 
     def get_date(self, field, level):
@@ -89,10 +330,12 @@ class Ambient(object):
             field,
             level)
         try:
-            date_entries = requests.get(
+            date_entries = self.meteo_transport.get(
                 dates_url,
                 headers=self.__meteo_headers,
                 timeout=1.000)
+        except CircuitOpenError:
+            status = {"error": "get_date_open"}
         except requests.Timeout:
             status = {"error": "get_date_tout"}
         except requests.ConnectionError:
@@ -115,10 +358,11 @@ class Ambient(object):
                 status = {"error": "NONE"}
             else:
                 status = {"error": "get_date_" + str(date_entries.status_code)}
+        metrics.count_error(status["error"])
         return status
 
+    # The date of the model run is not discovered here - it's done once by renew_forecast(), for all the fields.
     def data_point_url(self, field, level):
-        self.get_date(field, level)
         forecast_url = "{}/api/{}/model/{}/grid/{}/coordinates/{}/field/{}/level/{}/date/{}/forecast/".format(
             self.__config["meteo_url"],
             self.__config["api"],
@@ -141,12 +385,20 @@ class Ambient(object):
 
     def get_forecast(self, field, level):
         output = {}
+        backoff = self.__config.get("retry_backoff", 0.25)
         for retries in range(0,3):
+            if retries > 0:
+                # Real time on purpose, it's the API that needs a break. Jitter keeps the threads from retrying at once.
+                time.sleep(backoff * 2 ** (retries - 1) * (1.0 - 0.5 * random.random()))
             try:
-                response = requests.post(
+                response = self.meteo_transport.post(
                     self.data_point_url(field, level)["forecast"],
                     headers=self.__meteo_headers,
                     timeout=1.000)
+            except CircuitOpenError:
+                status = {"error": "get_fcst_open"}
+                metrics.count_error(status["error"])
+                break   # The API is down, retrying now would only wait for the timeouts again.
             except requests.Timeout:
                 status = {"error": "get_fcst_tout"}
             except requests.ConnectionError:
@@ -160,25 +412,69 @@ class Ambient(object):
                     break
                 else:
                     status = {"error": "get_fcst_" + str(response.status_code)}
+            metrics.count_error(status["error"])   # Every failed attempt is counted, the successful one breaks out.
         print("{} ; {} ; {}".format(retries, status, output))
         return output, status
 
     def renew_forecast(self):
-        temperature_forecast, status = self.get_forecast(
-            self.__config["temperature_field"],
-            self.__config["temperature_level"])
-        if status["error"] == "NONE":
-            self.__temperature = temperature_forecast
-        precipitation_forecast, status = self.get_forecast(
-            self.__config["precipitation_field"],
-            self.__config["precipitation_level"])
-        if status["error"] == "NONE":
-            self.__precipitation = precipitation_forecast
-        solar_radiation_forecast, status = self.get_forecast(
-            self.__config["solar_radiation_field"],
-            self.__config["solar_radiation_level"])
-        if status["error"] == "NONE":
-            self.__solar_radiation = solar_radiation_forecast
+        if self.__meteo_coordinates == "":
+            status = self.get_coordinates()
+            if status["error"] != "NONE":
+                return False
+        # All three fields come from the same model run, so its date is discovered once and shared by all the
+        # requests and their retries. If the discovery fails, the date of the previous run is used, if there's any.
+        status = self.get_date(self.__config["temperature_field"], self.__config["temperature_level"])
+        if status["error"] != "NONE" and self.__meteo_date == "":
+            return False
+        ttl = self.__config.get("cache_forecast_ttl", 21600.0)
+        received = {}
+        jobs = {}
+        # The fields are independent, so they are fetched at once. Only those which aren't cached yet, though.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            for name in FORECAST_FIELDS:
+                if self.cache is not None:
+                    cached = self.cache.load(self.forecast_key(name) + [self.__meteo_date], ttl)
+                    if cached is not None:
+                        received.update({name: cached})
+                        continue
+                jobs.update({name: executor.submit(self.get_forecast,
+                                                   self.__config[name + "_field"],
+                                                   self.__config[name + "_level"])})
+        for name in jobs:
+            forecast, status = jobs[name].result()
+            if status["error"] == "NONE":
+                received.update({name: forecast})
+                if self.cache is not None:
+                    self.cache.store(self.forecast_key(name) + [self.__meteo_date], forecast)
+        self.apply_forecast(received)
+        return True
+
+    # New forecasts are parsed into trajectories and swapped in, fields which are not given stay as they were.
+    def apply_forecast(self, received: dict) -> bool:
+        forecast = dict(self.__forecast)
+        trajectory = dict(self.__trajectory)
+        step = self.__config.get("trajectory_step", 60.0)
+        for name in received:
+            key, offset = FORECAST_FIELDS[name]
+            forecast[name] = received[name]
+            trajectory[key] = build_trajectory(received[name], offset, step)
+        self.__forecast = forecast
+        self.__trajectory = trajectory
+        return True
+
+    # At the start, whatever is still valid in the cache is served immediately, without asking the APIs.
+    def restore_from_cache(self) -> bool:
+        if self.cache is None or self.__meteo_coordinates == "":
+            return False
+        received = {}
+        for name in FORECAST_FIELDS:
+            cached = self.cache.latest(self.forecast_key(name), self.__config.get("cache_forecast_ttl", 21600.0))
+            if cached is not None:
+                received.update({name: cached})
+        self.apply_forecast(received)
+        cached = self.cache.load(["dust", self.__config["pm10_id"]], self.__config.get("cache_dust_ttl", 3600.0))
+        if cached is not None:
+            self.__dust_measure = cached
         return True
 
     # "id":736,"stationName":"Gdańsk, ul. Leczkowa","gegrLat":"54.380279","gegrLon":"18.620274"
@@ -191,9 +487,17 @@ class Ambient(object):
     #   "id":4681,"paramName":"pył zawieszony PM10"
     # Given PM2.5 and PM10 values are micrograms per cubic meter ug/m3.
     def renew_dust_measure(self):
+        # Cached series is good enough, unless the measure for the latest hour was still missing (reported as 0.0).
+        if self.cache is not None:
+            cached = self.cache.load(["dust", self.__config["pm10_id"]], self.__config.get("cache_dust_ttl", 3600.0))
+            if cached is not None and len(cached["data"]) > 0 and cached["data"][0] > 0.0:
+                self.__dust_measure = cached
+                return {"error": "NONE"}
         pm10_url = self.__config["gios_url"] + self.__config["pm10_id"]
         try:
-            dust_data = requests.get(pm10_url, timeout=1.500)
+            dust_data = self.gios_transport.get(pm10_url, timeout=1.500)
+        except CircuitOpenError:
+            status = {"error": "get_du_open"}
         except requests.Timeout:
             status = {"error": "get_du_tout"}
         except requests.ConnectionError:
@@ -202,75 +506,51 @@ class Ambient(object):
             status = {"error": "get_du_othr"}
         else:
             if dust_data.status_code == 200:
-                self.__dust_measure = {"times": [], "data": []}
+                dust_measures = {"times": [], "data": []}
                 dust_record = dust_data.json()
                 for data in dust_record["values"]:
                     if data["value"] not in ["None", None]:
                         dust_measure = float(data["value"])
                     else:
                         dust_measure = 0.0
-                    self.__dust_measure["times"].append(data["date"][0:16])
-                    self.__dust_measure["data"].append(dust_measure)
+                    dust_measures["times"].append(data["date"][0:16])
+                    dust_measures["data"].append(dust_measure)
+                self.__dust_measure = dust_measures
+                if self.cache is not None:
+                    self.cache.store(["dust", self.__config["pm10_id"]], dust_measures)
                 status = {"error": "NONE"}
             else:
                 status = {"error": "get_du_" + str(dust_data.status_code)}
+        metrics.count_error(status["error"])
         print("{} ; {}".format(status, self.__dust_measure))
         return status
 
-    def simulate(self):
-        current_date = time.strftime("%Y-%m-%d")
-        current_hour = time.strftime("%H")
-        current_min = time.strftime("%M")
-        # Data from meteo API is sliced in 6-hours slots, thus the data must be taken fom 00, 06, 12, 18 hour entries
-        if int(current_hour) < 6:
-            last_hour = "00"
-        elif int(current_hour) < 12:
-            last_hour = "06"
-        elif int(current_hour) < 18:
-            last_hour = "12"
-        else:
-            last_hour = "18"
-        last_timestamp = "{}T{}:00".format(current_date, last_hour)
-        elapsed_minutes = (int(current_hour) % 6) * 60 + int(current_min)
-        # To calculate current temperature, interpolation must be done based on the values from surrounding API readings
-        # between the moment defined by last_timestamp and the one after
-        # elapsed_minutes define how much time have passed from the last_timestamp
-        last_temp = next_temp = 0.0
-        if "times" in self.__temperature.keys():
-            for index, timestamp in enumerate(self.__temperature["times"]):
-                if last_timestamp in timestamp:
-                    last_temp = float(self.__temperature["data"][index]) - 273.0
-                    next_temp = float(self.__temperature["data"][index + 1]) - 273.0
-                    break
-        self.__current["temp"] = last_temp + 1/360 * elapsed_minutes * (next_temp - last_temp)
-        # This part of the code calculates current precipitation
-        last_preci = next_preci = 0.0
-        if "times" in self.__precipitation.keys():
-            for index, timestamp in enumerate(self.__precipitation["times"]):
-                if last_timestamp in timestamp:
-                    last_preci = float(self.__precipitation["data"][index])
-                    next_preci = float(self.__precipitation["data"][index + 1])
-                    break
-        self.__current["preci"] = last_preci + 1/360 * elapsed_minutes * (next_preci - last_preci)
-        # This part of the code calculates current solar radiation
-        last_solar = next_solar = 0.0
-        if "times" in self.__solar_radiation.keys():
-            for index, timestamp in enumerate(self.__solar_radiation["times"]):
-                if last_timestamp in timestamp:
-                    last_solar = float(self.__solar_radiation["data"][index])
-                    next_solar = float(self.__solar_radiation["data"][index + 1])
-                    break
-        self.__current["solar"] = last_solar + 1/360 * elapsed_minutes * (next_solar - last_solar)
+    # Weather conditions at any simulated moment, taken from the precomputed trajectories.
+    def conditions_at(self, timestamp: float) -> dict:
+        trajectory = self.__trajectory   # One consistent set of trajectories for the whole lookup.
+        return {"temp": trajectory_value(trajectory["temp"], timestamp),
+                "preci": trajectory_value(trajectory["preci"], timestamp),
+                "solar": trajectory_value(trajectory["solar"], timestamp)}
+
+    # When the simulation state is given, current conditions are written into it as well.
+    def simulate(self, op_data=None):
+        # Data from meteo API is sliced in 6-hours slots. Interpolation between them is already done when the forecast
+        # is received (see build_trajectory), so here it's only the lookup of current values.
+        conditions = self.conditions_at(self.__clock.time())
+        self.__current["temp"] = conditions["temp"]
+        self.__current["preci"] = conditions["preci"]
+        self.__current["solar"] = conditions["solar"]
         # Current PM10 dust concentration must be calculated as well, but the data comes from another API
         # This API responds with historical data, not simulated future values. Moreover, data for current hour
         # can be delayed for a quarter or so - and in this case API responds with 0.0 dust concentration ;)
         # And finally, this data is prepared in 1-hour slices - not in 6-hour slices. Funny, isn't it? ;)
         # Extrapolation algorithm must be smart enough to handle that.
-        if "times" in self.__dust_measure.keys():
-            dust_n0 = self.__dust_measure["data"][0]
-            dust_n1 = self.__dust_measure["data"][1]
-            dust_n2 = self.__dust_measure["data"][2]
-            dust_n3 = self.__dust_measure["data"][3]
+        dust_measure = self.__dust_measure
+        if "times" in dust_measure.keys():
+            dust_n0 = dust_measure["data"][0]
+            dust_n1 = dust_measure["data"][1]
+            dust_n2 = dust_measure["data"][2]
+            dust_n3 = dust_measure["data"][3]
             if dust_n0 > 0.0:
                 self.__current["dust"] = 1/4 * (dust_n0 + dust_n1 + dust_n2 + dust_n3)
             elif dust_n1 > 0.0:
@@ -281,4 +561,135 @@ class Ambient(object):
                 self.__current["dust"] = 1/1 * (dust_n3)
         else:
             self.__current["dust"] = 0.0
+        if op_data is not None:
+            op_data["temp"] = self.__current["temp"]
+            op_data["preci"] = self.__current["preci"]
+            op_data["solar"] = self.__current["solar"]
+            op_data["dust"] = self.__current["dust"]
         return self.__current
+
+
+# Background fetcher, which keeps the forecast and the dust measures of an Ambient object fresh on its own schedule,
+# so the control loop never waits for the outside APIs - it just calls Ambient.simulate(), which reads from memory.
+# Periods are given in real seconds: the APIs don't care how fast the simulation clock runs.
+class AmbientFetcher(object):
+    def __init__(self, ambient, forecast_period=3600.0, dust_period=600.0):
+        self.__ambient = ambient
+        self.__forecast_period = forecast_period
+        self.__dust_period = dust_period
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.run, name="ambient_fetcher", daemon=True)
+
+    def start(self):
+        self.__thread.start()
+        return True
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+        return True
+
+    def run(self):
+        next_forecast = next_dust = time.monotonic()   # Both are fetched right after the start.
+        while not self.__stop.is_set():
+            now = time.monotonic()
+            if now >= next_forecast:
+                next_forecast = now + self.__forecast_period
+                try:
+                    self.__ambient.renew_forecast()
+                except Exception as exception:   # The thread must survive any failure, next period will try again.
+                    print("{} ; {}".format({"error": "bg_fcst_othr"}, exception))
+            if now >= next_dust:
+                next_dust = now + self.__dust_period
+                try:
+                    self.__ambient.renew_dust_measure()
+                except Exception as exception:
+                    print("{} ; {}".format({"error": "bg_du_othr"}, exception))
+            self.__stop.wait(max(0.0, min(next_forecast, next_dust) - time.monotonic()))
+
+
+# Weather service for many sites in one process. Sites are grouped by grid cell (for the forecasts) and by GIOS station
+# (for the dust measures). Each group is fetched once, by its first site, and the result is handed to all the others.
+# This way the API traffic grows with the number of distinct cells and stations, not with the number of buildings.
+# The service has the same renew_forecast / renew_dust_measure methods as Ambient, so AmbientFetcher can drive it.
+# Across processes, the deduplication is done by the on-disk cache, when the processes share the same cache_dir.
+class WeatherService(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__locations = {}   # Resolved grid coordinates, by location key.
+        self.__sites = []   # Subscribed sites, in the order of subscription.
+
+    @property
+    def sites(self):
+        return self.__sites
+
+    # Sites grouped by grid cell, as they are now. Groups are built again on every renewal, so a site whose location
+    # was changed by a config reload moves to its new cell. A site without resolved coordinates isn't in any cell -
+    # with "" in the key, sites from different locations would end up sharing one forecast.
+    @property
+    def cells(self) -> dict:
+        with self.__lock:
+            sites = list(self.__sites)
+        cells = {}
+        for ambient in sites:
+            if ambient.meteo_coordinates != "":
+                cells.setdefault(ambient.cell_key(), []).append(ambient)
+        return cells
+
+    @property
+    def stations(self) -> dict:
+        with self.__lock:
+            sites = list(self.__sites)
+        stations = {}
+        for ambient in sites:
+            stations.setdefault(ambient.station_key(), []).append(ambient)
+        return stations
+
+    # Grid coordinates are resolved once for each location. Until they are, the site gets no forecast.
+    def resolve(self, ambient) -> dict:
+        if ambient.meteo_coordinates != "":
+            return {"error": "NONE"}
+        location_key = ambient.location_key()
+        with self.__lock:
+            coordinates = self.__locations.get(location_key)
+        if coordinates is not None:
+            ambient.meteo_coordinates = coordinates
+            return {"error": "NONE"}
+        status = ambient.get_coordinates()
+        if status["error"] == "NONE":
+            with self.__lock:
+                self.__locations.update({location_key: ambient.meteo_coordinates})
+        return status
+
+    def subscribe(self, ambient) -> dict:
+        with self.__lock:
+            self.__sites.append(ambient)
+        status = self.resolve(ambient)
+        if status["error"] == "NONE":
+            sites = self.cells[ambient.cell_key()]
+            if sites[0] is not ambient:
+                ambient.share_forecast(sites[0].weather)
+        return status
+
+    # Sites whose coordinates couldn't be resolved so far (or were reset by a new location) are tried again first.
+    def renew_forecast(self):
+        with self.__lock:
+            sites = list(self.__sites)
+        for ambient in sites:
+            self.resolve(ambient)
+        for sites in self.cells.values():
+            sites[0].renew_forecast()
+            for ambient in sites[1:]:
+                ambient.share_forecast(sites[0].weather)
+        return True
+
+    def renew_dust_measure(self):
+        for sites in self.stations.values():
+            sites[0].renew_dust_measure()
+            for ambient in sites[1:]:
+                ambient.dust_measure = sites[0].dust_measure
+        return True
+
+
+# One service for the whole process.
+weather_service = WeatherService()
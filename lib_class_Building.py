@@ -1,15 +1,111 @@
 # packages
 # import requests
 # from datetime import datetime
-import time
+# import time
+from collections import namedtuple
+from lib_class_OpData import OpData
+from lib_class_other import Clock, changed_keys, check_config
 
 
 # defs
+# Parameters of the simplified model, compiled once from building_data.txt. Each layer (room, construction,
+# insulation) has its averaging weights - the new temperature is pulled towards weight * neighbour + rest * the other
+# neighbour - and the rate, which is 1 / time constant.
+BUILDING_KEYS = ("room_avg", "room_tau", "constr_avg", "constr_tau", "insul_avg", "insul_tau")
+BuildingParams = namedtuple("BuildingParams", BUILDING_KEYS + ("room_weight", "room_rest", "room_rate",
+                                                                "constr_weight", "constr_rest", "constr_rate",
+                                                                "insul_weight", "insul_rest", "insul_rate"))
+
+# All the entries used by the extended model, all are numbers. The dimensions, thicknesses, densities and specific
+# heats end up as divisors (building volume, conductances, heat-up energies), so they must be greater than 0.
+BUILDINGEX_KEYS = ("building_D", "building_L", "building_H", "glass_ratio", "glass_capture",
+                   "concrete_thickness", "concrete_density", "concrete_lambda", "concrete_spec_heat",
+                   "air_thickness", "air_density", "air_lambda", "air_spec_heat",
+                   "styrofoam_thickness", "styrofoam_density", "styrofoam_lambda", "styrofoam_spec_heat")
+BUILDINGEX_POSITIVE = ("building_D", "building_L", "building_H",
+                       "concrete_thickness", "concrete_density", "concrete_spec_heat",
+                       "air_thickness", "air_density", "air_spec_heat",
+                       "styrofoam_thickness", "styrofoam_density", "styrofoam_spec_heat")
+# Parameters of the extended model, compiled once from buildingex_data.txt: the configured values and the constants
+# of the whole building derived from them - conductances [W/K] and heat-up energies [J/K] of the layers, specific
+# power of the windows and the volume of the air.
+BuildingExParams = namedtuple("BuildingExParams", BUILDINGEX_KEYS + ("wall_C", "wall_HE", "window_SP", "air_C",
+                                                                      "air_HE", "ins_C", "ins_HE", "building_vol"))
+
+
+# Slots of OpData written by each layer of the extended model: accumulated energy and power balance, with the keys
+# of the layer's conductance and heat-up energy in the parameters, and the temperatures the layer sets.
+LAYER_KEYS = {"air": ("air_AQ", "air_PB", "air_C", "air_HE"),
+              "wall": ("wall_AQ", "wall_PB", "wall_C", "wall_HE"),
+              "ins": ("ins_AQ", "ins_PB", "ins_C", "ins_HE")}
+LAYER_TEMPERATURES = {"air": ("temp_rm", "temp_ex"), "wall": ("temp_wall",), "ins": ("temp_ins",)}
+
+
+def check_buildingex_config(config: dict, config_path="") -> bool:
+    return check_config(config, BUILDINGEX_KEYS, config_path, positive=BUILDINGEX_POSITIVE)
+
+
+def buildingex_params(config: dict, config_path="") -> BuildingExParams:
+    check_buildingex_config(config, config_path)
+    # Wall area is calculated as sum of the flat roof (DxL) and all vertical walls (2xDxH+2xLxH).
+    # Assumption 1: no heat exchange through the bottom.
+    # Assumption 2: both roof and walls have the same structure - layer of concrete and insulation.
+    wall_area = config["building_D"] * config["building_L"] + \
+                2 * (config["building_D"] + config["building_L"]) * config["building_H"]
+    wall_volume = wall_area * config["concrete_thickness"]
+    wall_mass = wall_volume * config["concrete_density"]
+    # This conductance is not a material constant, but it's [W/K] for entire building.
+    wall_conductance = wall_area * config["concrete_lambda"] / config["concrete_thickness"]
+    # This heatup energy is not a material constant, but it's [J/K] for entire building.
+    wall_heatup_energy = wall_mass * config["concrete_spec_heat"]
+    # Window area is a fraction of the walls.
+    window_area = config["glass_ratio"] * config["building_L"] * config["building_H"]
+    # Window specific power is parameter of entire glass surface.
+    # Note: windows are not calculated separately for heat insulation/dissipation.
+    window_spec_power = window_area * config["glass_capture"]
+    air_volume = config["building_D"] * config["building_L"] * config["building_H"]
+    air_mass = air_volume * config["air_density"]
+    air_conductance = wall_area * config["air_lambda"] / config["air_thickness"]
+    air_heatup_energy = air_mass * config["air_spec_heat"]
+    insulation_volume = wall_area * config["styrofoam_thickness"]
+    insulation_mass = insulation_volume * config["styrofoam_density"]
+    insulation_conductance = wall_area * config["styrofoam_lambda"] / config["styrofoam_thickness"]
+    insulation_heatup_energy = insulation_mass * config["styrofoam_spec_heat"]
+    return BuildingExParams(wall_C=wall_conductance, wall_HE=wall_heatup_energy, window_SP=window_spec_power,
+                            air_C=air_conductance, air_HE=air_heatup_energy,
+                            ins_C=insulation_conductance, ins_HE=insulation_heatup_energy, building_vol=air_volume,
+                            **{key: config[key] for key in BUILDINGEX_KEYS})
+
+
+def building_params(config: dict, config_path="") -> BuildingParams:
+    # The weights may be 0 (the layer follows one neighbour only), the time constants are divided by.
+    check_config(config, BUILDING_KEYS, config_path, positive=("room_tau", "constr_tau", "insul_tau"))
+    return BuildingParams(room_avg=config["room_avg"],
+                          room_tau=config["room_tau"],
+                          constr_avg=config["constr_avg"],
+                          constr_tau=config["constr_tau"],
+                          insul_avg=config["insul_avg"],
+                          insul_tau=config["insul_tau"],
+                          room_weight=config["room_avg"] / (config["room_avg"] + 1),
+                          room_rest=1 / (config["room_avg"] + 1),
+                          room_rate=1 / config["room_tau"],
+                          constr_weight=config["constr_avg"] / (config["constr_avg"] + 1),
+                          constr_rest=1 / (config["constr_avg"] + 1),
+                          constr_rate=1 / config["constr_tau"],
+                          insul_weight=config["insul_avg"] / (config["insul_avg"] + 1),
+                          insul_rest=1 / (config["insul_avg"] + 1),
+                          insul_rate=1 / config["insul_tau"])
+
+
 # Simplified model, with sensible response, but without sophisticated modelling and calculations.
 class Building(object):
-    def __init__(self, temp_room=20.0, temp_constr=15.0, temp_insul=10.0, config_path="building_data.txt"):
+    def __init__(self, temp_room=20.0, temp_constr=15.0, temp_insul=10.0, config_path="building_data.txt", clock=None):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
         self.__config_path = config_path
         self.__config = {}
+        self.__params = None
         # room_avg = 1 / List of fields available/expected in TXT configuration.
         # room_tau = 1
         # constr_avg = 2
@@ -20,8 +116,8 @@ class Building(object):
         self.__temp_room = [temp_room, temp_room]
         self.__temp_constr = [temp_constr, temp_constr]
         self.__temp_insul = [temp_insul, temp_insul]
-        self.__curr_time = time.time()
-        self.__last_time = time.time()
+        self.__curr_time = self.__clock.time()
+        self.__last_time = self.__clock.time()
 
     @property
     def config_path(self):
@@ -33,36 +129,69 @@ class Building(object):
 
     @config.setter
     def config(self, config: dict):
+        if len(changed_keys(self.__config, config) & set(BUILDING_KEYS)) > 0:
+            self.__params = None   # compiled again on next use
         self.__config = config
 
-    def calculate(self, op_data: dict):
-        # prepare data
+    @property
+    def params(self):
+        if self.__params is None:
+            self.initialize_params()
+        return self.__params
+
+    # Should be called right after the config is loaded, so that a broken config stops the script at startup.
+    def initialize_params(self) -> bool:
+        self.__params = building_params(self.__config, self.__config_path)
+        return True
+
+    # Internal state of the model, for checkpoints. The time of restoring becomes the last calculation time, so the
+    # first step after restart doesn't include the downtime.
+    @property
+    def state(self):
+        return {"temp_room": list(self.__temp_room),
+                "temp_constr": list(self.__temp_constr),
+                "temp_insul": list(self.__temp_insul)}
+
+    @state.setter
+    def state(self, state: dict):
+        self.__temp_room = list(state["temp_room"])
+        self.__temp_constr = list(state["temp_constr"])
+        self.__temp_insul = list(state["temp_insul"])
+        self.__curr_time = self.__last_time = self.__clock.time()
+
+    def calculate(self, op_data):
+        # prepare data (OpData is updated in place, a plain dict is still accepted and only gets the results returned)
+        if type(op_data) == dict:
+            op_data = OpData(op_data)
         temp_rm = self.__temp_room[0]
         temp_con = self.__temp_constr[0]
         temp_ins = self.__temp_insul[0]
-        avg_rm = self.__config["room_avg"]
-        avg_con = self.__config["constr_avg"]
-        avg_ins = self.__config["insul_avg"]
-        tau_rm = self.__config["room_tau"]
-        tau_con = self.__config["constr_tau"]
-        tau_ins = self.__config["insul_tau"]
+        params = self.params
         # handle timing
-        self.__curr_time = time.time()
+        self.__curr_time = self.__clock.time()
         ti_diff = (self.__curr_time - self.__last_time) / 3600
         print("ti_diff : {:1.5} sec".format(self.__curr_time - self.__last_time))
         self.__last_time = self.__curr_time
         # do calculations
-        if op_data["flow_su"] > 0.0:
-            coeff = op_data["flow_su"]/7610.0
+        if op_data.flow_su > 0.0:
+            coeff = op_data.flow_su/7610.0
         else:
             coeff = 1.0
-        self.__temp_room[1] = temp_rm + ((avg_rm * op_data["temp_su"] + temp_con) / (avg_rm + 1) - temp_rm) * coeff * (ti_diff / tau_rm)
-        self.__temp_constr[1] = temp_con + ((avg_con * self.__temp_room[1] + temp_ins) / (avg_con + 1) - temp_con) * 1 * (ti_diff / tau_con)
-        self.__temp_insul[1] = temp_ins + ((avg_ins * self.__temp_constr[1] + op_data["temp"]) / (avg_ins + 1) - temp_ins) * 1 * (ti_diff / tau_ins)
+        room_target = params.room_weight * op_data.temp_su + params.room_rest * temp_con
+        self.__temp_room[1] = temp_rm + (room_target - temp_rm) * coeff * ti_diff * params.room_rate
+        constr_target = params.constr_weight * self.__temp_room[1] + params.constr_rest * temp_ins
+        self.__temp_constr[1] = temp_con + (constr_target - temp_con) * ti_diff * params.constr_rate
+        insul_target = params.insul_weight * self.__temp_constr[1] + params.insul_rest * op_data.temp
+        self.__temp_insul[1] = temp_ins + (insul_target - temp_ins) * ti_diff * params.insul_rate
         # update storage
         self.__temp_room[0] = self.__temp_room[1]
         self.__temp_constr[0] = self.__temp_constr[1]
         self.__temp_insul[0] = self.__temp_insul[1]
+        # the state is updated in place, the dict is returned as before
+        op_data.temp_rm = op_data.temp_ex = self.__temp_room[1]
+        op_data.temp_con = self.__temp_constr[1]
+        op_data.temp_ins = self.__temp_insul[1]
+        op_data.ti_diff = ti_diff
         return {"temp_rm": self.__temp_room[1],
                 "temp_con": self.__temp_constr[1],
                 "temp_ins": self.__temp_insul[1],
@@ -92,10 +221,13 @@ def limit(input, min, max):
 
 # Extended model, with sophisticated modelling and calculations.
 class BuildingEx(object):
-    def __init__(self, config_path="buildingex_data.txt"):
+    def __init__(self, config_path="buildingex_data.txt", clock=None):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
         self.__config_path = config_path
         self.__config = {}
-        self.__params = {}
+        self.__params = None
 
     @property
     def config_path(self):
@@ -107,96 +239,71 @@ class BuildingEx(object):
 
     @config.setter
     def config(self, config: dict):
+        changed = changed_keys(self.__config, config)
         self.__config = config
+        # When the config is replaced in a running model, the derived parameters are recomputed, but only if any of
+        # their inputs has changed. Before the first initialize_params() there's nothing to recompute.
+        if self.__params is not None and len(changed & set(BUILDINGEX_KEYS)) > 0:
+            self.initialize_params()
 
+    # Compiled parameters, read-only - a new config gives a new block, always checked.
     @property
     def params(self):
+        if self.__params is None:
+            self.initialize_params()
         return self.__params
 
-    @params.setter
-    def params(self, params: dict):
-        self.__params = params
-
+    # Should be called right after the config is loaded, so that a broken config stops the script at startup.
     def initialize_params(self) -> bool:
-        # These are constant parameters which characterize the building.
-        # Wall area is calculated as sum of the flat roof (DxL) and all vertical walls (2xDxH+2xLxH).
-        # Assumption 1: no heat exchange through the bottom.
-        # Assumption 2: both roof and walls have the same structure - layer of concrete and insulation.
-        wall_area = self.__config["building_D"] * self.__config["building_L"] + \
-                    2 * (self.__config["building_D"] + self.__config["building_L"]) * self.__config["building_H"]
-        wall_volume = wall_area * self.__config["concrete_thickness"]
-        wall_mass = wall_volume * self.__config["concrete_density"]
-        # This conductance is not a material constant, but it's [W/K] for entire building.
-        wall_conductance = wall_area * self.__config["concrete_lambda"] / self.__config["concrete_thickness"]
-        # This heatup energy is not a material constant, but it's [J/K] for entire building.
-        wall_heatup_energy = wall_mass * self.__config["concrete_spec_heat"]
-        # Window area is a fraction of the walls.
-        window_area = self.__config["glass_ratio"] * self.__config["building_L"] * self.__config["building_H"]
-        # Window specific power is parameter of entire glass surface.
-        # Note: windows are not calculated separately for heat insulation/dissipation.
-        window_spec_power = window_area * self.__config["glass_capture"]
-        air_volume = self.__config["building_D"] * self.__config["building_L"] * self.__config["building_H"]
-        air_mass = air_volume * self.__config["air_density"]
-        air_conductance = wall_area * self.__config["air_lambda"] / self.config["air_thickness"]
-        air_heatup_energy = air_mass * self.__config["air_spec_heat"]
-        insulation_volume = wall_area * self.__config["styrofoam_thickness"]
-        insulation_mass = insulation_volume * self.__config["styrofoam_density"]
-        insulation_conductance = wall_area * self.__config["styrofoam_lambda"] / self.__config["styrofoam_thickness"]
-        insulation_heatup_energy = insulation_mass * self.__config["styrofoam_spec_heat"]
-        # These are constants stored internally in the building object
-        self.__params["wall_C"] = wall_conductance
-        self.__params["wall_HE"] = wall_heatup_energy
-        self.__params["window_SP"] = window_spec_power
-        self.__params["air_C"] = air_conductance
-        self.__params["air_HE"] = air_heatup_energy
-        self.__params["ins_C"] = insulation_conductance
-        self.__params["ins_HE"] = insulation_heatup_energy
+        self.__params = buildingex_params(self.__config, self.__config_path)
         return True
 
-    def power_delivery(self, op_data: dict) -> float:
-        temp_delta = op_data["temp_su"] - op_data["temp_rm"]
+    # The extended model works on OpData in place, like Building.calculate - each layer writes its accumulated energy,
+    # power balance and temperature straight into the slots, so the loop doesn't merge any results back.
+    def power_delivery(self, op_data: OpData) -> float:
+        temp_delta = op_data.temp_su - op_data.temp_rm
+        params = self.params
         power = transfer_efficiency(temp_delta) * temp_delta * \
-                self.__config["air_spec_heat"] * self.__config["air_density"] * 1/3600 * op_data["flow_su"] + \
-                self.__params["window_SP"] * op_data["solar"]
+                params.air_spec_heat * params.air_density * 1/3600 * op_data.flow_su + \
+                params.window_SP * op_data.solar
         return power
 
-    def calculate_layer(self, layer_name: str, op_data: dict, power_source: float, temp_sink: float) -> dict:
-        key_c = layer_name + "_C"
-        key_he = layer_name + "_HE"
-        key_aq = layer_name + "_AQ"
-        key_pb = layer_name + "_PB"
-        accumulated_energy = op_data[key_aq] + 0.0036 * op_data[key_pb] * op_data["ti_diff"]
-        temp_layer = 1000000 * accumulated_energy / self.__params[key_he] - 273.15
-        power_sink = (temp_layer - temp_sink) * self.__params[key_c]
-        power_balance = power_source - power_sink
-        return {"AQ": accumulated_energy,
-                "PB": power_balance,
-                "power_sink": power_sink,
-                "temperature": temp_layer}
-
-    def simulate_dioxide(self, op_data: dict) -> float:
-        if 7 <= int(time.strftime("%H")) <= 19:
-            if op_data["air_q"] < 1000.0:
-                number_of_people = int(5 + 100 * (op_data["preci"] / 25 + op_data["solar"] / 250 + op_data["dust"] / 50))
+    # Returns the power flowing out of the layer, which is the source of the next one.
+    def calculate_layer(self, layer_name: str, op_data: OpData, power_source: float, temp_sink: float) -> float:
+        key_aq, key_pb, key_c, key_he = LAYER_KEYS[layer_name]
+        accumulated_energy = getattr(op_data, key_aq) + 0.0036 * getattr(op_data, key_pb) * op_data.ti_diff
+        temp_layer = 1000000 * accumulated_energy / getattr(self.params, key_he) - 273.15
+        power_sink = (temp_layer - temp_sink) * getattr(self.params, key_c)
+        setattr(op_data, key_aq, accumulated_energy)
+        setattr(op_data, key_pb, power_source - power_sink)
+        for key in LAYER_TEMPERATURES[layer_name]:
+            setattr(op_data, key, temp_layer)
+        return power_sink
+
+    def simulate_dioxide(self, op_data: OpData) -> float:
+        activity = op_data.preci / 25 + op_data.solar / 250 + op_data.dust / 50
+        if 7 <= int(self.__clock.strftime("%H")) <= 19:
+            if op_data.air_q < 1000.0:
+                number_of_people = int(5 + 100 * activity)
                 number_of_people = limit(number_of_people, 50, 200)
-            elif op_data["air_q"] < 1250.0:
-                number_of_people = int(5 + 70 * (op_data["preci"] / 25 + op_data["solar"] / 250 + op_data["dust"] / 50))
+            elif op_data.air_q < 1250.0:
+                number_of_people = int(5 + 70 * activity)
                 number_of_people = limit(number_of_people, 35, 140)
-            elif op_data["air_q"] < 1500.0:
-                number_of_people = int(5 + 40 * (op_data["preci"] / 25 + op_data["solar"] / 250 + op_data["dust"] / 50))
+            elif op_data.air_q < 1500.0:
+                number_of_people = int(5 + 40 * activity)
                 number_of_people = limit(number_of_people, 20, 80)
             else:
-                number_of_people = int(5 + 20 * (op_data["preci"] / 25 + op_data["solar"] / 250 + op_data["dust"] / 50))
+                number_of_people = int(5 + 20 * activity)
                 number_of_people = limit(number_of_people, 10, 40)
         else:
-            number_of_people = int(5 + 10 * (op_data["preci"] / 25 + op_data["solar"] / 250 + op_data["dust"] / 50))
+            number_of_people = int(5 + 10 * activity)
             number_of_people = limit(number_of_people, 5, 20)
         print(number_of_people)
         exhale_flow = number_of_people * 1200 * 0.0005
         exhale_co2 = 40000.0
         supply_co2 = 400.0
-        building_vol = self.__config["building_D"] * self.__config["building_L"] * self.__config["building_H"]
-        carbon_dioxide = ((exhale_flow * exhale_co2 + op_data["flow_su"] * supply_co2) * op_data["ti_diff"] + \
-                         (building_vol - (exhale_flow + op_data["flow_su"]) * op_data["ti_diff"]) * op_data["air_q"]) / \
-                         building_vol
-        return carbon_dioxide
+        building_vol = self.params.building_vol
+        op_data.air_q = ((exhale_flow * exhale_co2 + op_data.flow_su * supply_co2) * op_data.ti_diff +
+                         (building_vol - (exhale_flow + op_data.flow_su) * op_data.ti_diff) * op_data.air_q) / \
+                        building_vol
+        return op_data.air_q
@@ -0,0 +1,76 @@
+# packages
+import json
+import os
+import struct
+import zlib
+
+
+# defs
+# Checkpoint file: header (magic, format version, CRC32 and length of the payload) and zlib-compressed JSON payload.
+# JSON keeps floats exactly (they're written with full precision), so the restored state is identical to the saved
+# one. The header lets the loader reject a file which is damaged or comes from an incompatible version.
+MAGIC = b"CSCP"
+VERSION = 1
+HEADER = struct.Struct("<4sHII")
+
+
+# Snapshot of the whole simulation: op_data plus internal state of every model which has the "state" property
+# (Building, Scheduler). The "error" entry of op_data is left out - it belongs to the tick that set it, and a restored
+# one would look like a fresh communication error until the next tick clears it. It's written atomically - to
+# a temporary file, flushed to disk and renamed over the previous checkpoint, so there's always one complete
+# checkpoint on disk, whenever the script crashes.
+class Checkpoint(object):
+    def __init__(self, checkpoint_path="checkpoint.bin"):
+        self.__checkpoint_path = checkpoint_path
+
+    @property
+    def checkpoint_path(self):
+        return self.__checkpoint_path
+
+    def save(self, op_data: dict, models: dict) -> bool:
+        snapshot = {"op_data": {key: op_data[key] for key in op_data if key != "error"}, "models": {}}
+        for name in models:
+            snapshot["models"].update({name: models[name].state})
+        payload = zlib.compress(json.dumps(snapshot).encode("utf-8"))
+        temp_path = self.__checkpoint_path + ".tmp"
+        checkpoint_file = open(temp_path, mode="wb")
+        checkpoint_file.write(HEADER.pack(MAGIC, VERSION, zlib.crc32(payload), len(payload)))
+        checkpoint_file.write(payload)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+        checkpoint_file.close()
+        os.replace(temp_path, self.__checkpoint_path)
+        # The rename itself must reach the disk too, that's what the directory sync is for (not available on Windows).
+        if hasattr(os, "O_DIRECTORY"):
+            directory = os.open(os.path.dirname(os.path.abspath(self.__checkpoint_path)), os.O_RDONLY | os.O_DIRECTORY)
+            os.fsync(directory)
+            os.close(directory)
+        return True
+
+    # Returns the snapshot, or None when there's no valid checkpoint.
+    def load(self):
+        try:
+            checkpoint_file = open(self.__checkpoint_path, mode="rb")
+        except FileNotFoundError:
+            return None
+        content = checkpoint_file.read()
+        checkpoint_file.close()
+        if len(content) < HEADER.size:
+            return None
+        magic, version, crc, length = HEADER.unpack_from(content, 0)
+        payload = content[HEADER.size:]
+        if magic != MAGIC or version != VERSION or len(payload) != length or zlib.crc32(payload) != crc:
+            return None
+        return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+    # The op_data is updated in place and the models get their state back. Models missing in the checkpoint are left
+    # as they are. Returns False when there was nothing to restore.
+    def restore(self, op_data: dict, models: dict) -> bool:
+        snapshot = self.load()
+        if snapshot is None:
+            return False
+        op_data.update({key: snapshot["op_data"][key] for key in snapshot["op_data"] if key != "error"})
+        for name in models:
+            if name in snapshot["models"]:
+                models[name].state = snapshot["models"][name]
+        return True
@@ -1,5 +1,10 @@
 # packages
+from collections import namedtuple
 import requests
+from lib_class_Metrics import metrics
+from lib_class_OpData import OpData
+from lib_class_Transport import CircuitBreaker, CircuitOpenError, Transport, endpoint_name
+from lib_class_other import Clock, changed_keys, check_config
 # from datetime import datetime
 # import time
 
@@ -46,8 +51,171 @@ def filter_curve(dust_deposit: float, air_speed: float) -> float:
     return final_dp
 
 
+# Heat capacity of the air flow [kW/K per m3/h] - 1.2 kg/m3 * 1005 J/kgK, converted from hours and from watts.
+AIR_HEAT_CAPACITY = 1.2 * 1005 / 3600 / 1000
+
+# Parameters of the AHU model, compiled once from climatix_data.txt. Besides the configured values there are the
+# constants derived from them, so the model doesn't recompute them on every tick. Being a namedtuple, it can't be
+# changed by accident - a new config gives a new block.
+AHU_KEYS = ("ahu_vol", "ahu_spd", "ahu_htg", "ahu_clg", "hrec_eff")
+AhuParams = namedtuple("AhuParams", AHU_KEYS + ("flow_per_pos", "flow_step_1", "speed_per_flow",
+                                                "htg_per_pos", "clg_per_pos", "hrec_per_pos"))
+
+
+def ahu_params(config: dict, config_path="") -> AhuParams:
+    check_config(config, AHU_KEYS, config_path, positive=("ahu_vol",))
+    return AhuParams(ahu_vol=config["ahu_vol"],
+                     ahu_spd=config["ahu_spd"],
+                     ahu_htg=config["ahu_htg"],
+                     ahu_clg=config["ahu_clg"],
+                     hrec_eff=config["hrec_eff"],
+                     flow_per_pos=config["ahu_vol"] / 100,   # flow [m3/h] per 1% of fan output
+                     flow_step_1=config["ahu_vol"] * 2/3,   # flow at fan step 1, step 2 is the nominal flow
+                     speed_per_flow=config["ahu_spd"] / config["ahu_vol"],
+                     htg_per_pos=config["ahu_htg"] / 100,   # heating power [kW] per 1% of valve position
+                     clg_per_pos=config["ahu_clg"] / 100,
+                     hrec_per_pos=config["hrec_eff"] / 100)
+
+
+# Communication entries and data points of climatix_data.txt needed by the simulators - everything that's read or
+# written on a tick. All of them are texts (URL, credentials, BASE64 references).
+COMM_KEYS = ("climatix_url", "climatix_name", "climatix_pass", "climatix_pin",
+             "present_val", "tracking_sel", "tracking_com_val", "offset_corr_apl")
+POINT_KEYS = ("damp_cmd", "fan_su_cmd", "fan_su_pos", "fan_ex_cmd", "fan_ex_pos", "hrec_pos", "pump_cmd", "htg_pos",
+              "clg_cmd", "clg_pos", "flow_su", "flow_ex", "temp", "temp_su", "temp_rm", "temp_ex", "temp_eh",
+              "filt_su_pres", "filt_ex_pres", "air_q")
+
+
+# Full check of climatix_data.txt, for reloading it in a running simulator: the AHU parameters, the communication
+# and the data points.
+def check_climatix_config(config: dict, config_path="") -> bool:
+    return check_config(config, AHU_KEYS, config_path, positive=("ahu_vol",), text=COMM_KEYS + POINT_KEYS)
+
+
+# Entries of climatix_data.txt, which are not data points. Besides these, numeric entries (given in brackets) are not
+# data points either - they are parameters of the AHU model or of the communication - and neither are the polling
+# settings (poll_...).
+META_KEYS = ("climatix_url", "climatix_name", "climatix_pass", "climatix_pin",
+             "present_val", "tracking_sel", "tracking_com_val", "reliability_com", "offset_corr_apl")
+
+# Polling classes and their default periods [s]. Points are assigned to a class in climatix_data.txt, e.g.
+# poll_slow=damp_cmd,pump_cmd,clg_cmd, and the period can be changed, e.g. poll_slow_period=(120).
+POLL_CLASSES = {"fast": 3.0, "medium": 15.0, "slow": 60.0}
+
+
+# Polling period of each point assigned to a class. Points which aren't assigned are read every time.
+def poll_periods(config: dict) -> dict:
+    periods = {}
+    for name in POLL_CLASSES:
+        period = config.get("poll_{}_period".format(name), POLL_CLASSES[name])
+        for key in config.get("poll_" + name, "").split(","):
+            if key != "":
+                periods.update({key: period})
+    return periods
+
+# Typed descriptor of a single data point, compiled once from the configuration.
+# name - key used in op_data, body - BASE64 body of the reference, read_ref - full reference of the PresentValue,
+# write_refs - value prefixes ("reference;") for write modes 0, 1 and 2, tracking_ref - TrackingSelector = COM item,
+# decode - type the read value is converted to
+DataPoint = namedtuple("DataPoint", ["name", "body", "read_ref", "write_refs", "tracking_ref", "decode"])
+
+
+# Command signals are steps or on/off states, everything else is analog.
+def point_decode(name: str):
+    if name.endswith("_cmd"):
+        return int
+    else:
+        return float
+
+
+# Registry of the data points of one controller. It's built once from the configuration, then it provides prebuilt
+# request parameters for the read and write sets used by the script, and decodes the responses by reference ID.
+class PointRegistry(object):
+    def __init__(self, config: dict):
+        self.__pin = config["climatix_pin"]
+        self.__points = {}
+        self.__by_ref = {}
+        self.__read_templates = {}
+        self.__write_templates = {}
+        for key in config:
+            if key in META_KEYS or type(config[key]) != str or key.startswith("poll_"):
+                continue
+            body = config[key]
+            write_refs = (body + config["tracking_com_val"] + ";",
+                          body + config["present_val"] + ";",
+                          body + config["offset_corr_apl"] + ";")
+            point = DataPoint(key, body, body + config["present_val"], write_refs,
+                              body + config["tracking_sel"] + ";1", point_decode(key))
+            self.__points.update({key: point})
+            self.__by_ref.update({point.read_ref: point})
+            self.__by_ref.update({body: point})
+
+    @property
+    def points(self):
+        return self.__points
+
+    def read_params(self, ao_list: list) -> dict:
+        template_key = tuple(ao_list)
+        if template_key not in self.__read_templates:
+            self.__read_templates.update({template_key: {"fn": "read",
+                                                         "oa": [self.__points[key].read_ref for key in ao_list],
+                                                         "pin": self.__pin}})
+        return self.__read_templates[template_key]
+
+    # Write template is a list of (key, tracking item, value prefix) built once for each set of points and modes,
+    # so only the values have to be formatted on each call.
+    def write_params(self, ao_dict: dict, tracking_set=()) -> dict:
+        template_key = tuple((key, ao_dict[key][1]) for key in ao_dict)
+        if template_key not in self.__write_templates:
+            template = []
+            for key, mode in template_key:
+                point = self.__points[key]
+                if mode == 1:
+                    template.append((key, None, point.write_refs[1]))
+                elif mode == 2:
+                    template.append((key, None, point.write_refs[2]))
+                else:
+                    template.append((key, point.tracking_ref, point.write_refs[0]))
+            self.__write_templates.update({template_key: template})
+        params_list = []
+        for key, tracking_ref, value_ref in self.__write_templates[template_key]:
+            if tracking_ref is not None and key not in tracking_set:
+                params_list.append(tracking_ref)
+            params_list.append(value_ref + str(ao_dict[key][0]))
+        return {"fn": "write", "oa": params_list, "pin": self.__pin}
+
+    # Values are matched to the points by the reference given in the response, not by their position.
+    # References which don't belong to any known point are ignored.
+    # Decoded values are written into the given output (e.g. the simulation state) or into a new dict.
+    def decode(self, received: dict, output=None):
+        if output is None:
+            output = {}
+        for ref in received:
+            if ref in self.__by_ref:
+                point = self.__by_ref[ref]
+            elif ref[0:len(ref) - 4] in self.__by_ref:
+                point = self.__by_ref[ref[0:len(ref) - 4]]
+            else:
+                continue
+            if type(received[ref]) == list:
+                value = received[ref][0]
+            else:
+                value = received[ref]
+            try:
+                value = point.decode(value)
+            except (TypeError, ValueError):
+                pass   # Unexpected content is passed as it is, the model decides what to do with it.
+            output[point.name] = value
+        return output
+
+
 class Climatix(object):
-    def __init__(self, config_path="climatix_data.txt"):
+    # site - name of the site, which labels the controller's circuit breaker in the metrics (multi-site simulator)
+    def __init__(self, config_path="climatix_data.txt", clock=None, site=""):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
+        self.__site = site
         self.__config_path = config_path
         self.__config = {}
         # This is the list of key:value pairs, that should be provided for correct operation of the script.
@@ -63,6 +231,7 @@ class Climatix(object):
         # tracking_sel=QDA=
         # tracking_com_val=QzA=
         # reliability_com=RDA=
+        # offset_corr_apl=....   Suffix of the offset correction, the target of write mode 2 (e.g. air_q).
         # temp=AyLizxoD   These are the "bodies" of the BASE64 references, for example AyLizxoD____.
         # temp_su=AyJesBoD   They are combined together for sending appropriate control bits or tracking values
         # temp_rm=AyLj7BoD   or for the purpose of reading out the signals from the Climatix
@@ -76,6 +245,32 @@ class Climatix(object):
         # clg_pos=BiLNeBoD
         # filt_su_pres=AyIQnxoD
         # filt_ex_pres=AyJ8NRoD
+        # pool_connections=(1)   Optional, size of the keep-alive connection pool used for the JSONGEN requests.
+        # pool_maxsize=(1)
+        # deadband=(0.0)   Optional, write_changed() skips points which moved less than that since the last write.
+        # deadband_temp_eh=(0.05)   Deadband can be also given for a single point, by its key.
+        # integrity_period=(60)   Optional, every point is rewritten at least that often [s], even without changes.
+        # breaker_failures=(3)   Optional, circuit breaker of the controller: after that many failed requests in a row
+        # breaker_delay=(1)      the requests fail at once (get_rd_open, get_wr_open) and the last good values are
+        # breaker_max_delay=(60) kept. The controller is probed again after breaker_delay [s], doubled after every
+        #                        failed probe up to breaker_max_delay, and a successful probe closes the breaker.
+        # ahu_vol=(7600)   Parameters of the AHU model: nominal air flow [m3/h], air speed at nominal flow [m/s],
+        # ahu_spd=(2.5)    heater and cooler power [kW] and heat recovery efficiency. They are checked and compiled
+        # ahu_htg=(50)     by initialize_params().
+        # ahu_clg=(30)
+        # hrec_eff=(0.7)
+        # poll_fast=htg_pos,clg_pos,hrec_pos,fan_su_pos,fan_ex_pos   Optional, polling classes used by read_due():
+        # poll_medium=fan_su_cmd,fan_ex_cmd                          each point is read again only when the period
+        # poll_slow=damp_cmd,pump_cmd,clg_cmd                        of its class has passed. Periods are given by
+        # poll_fast_period=(3)   poll_medium_period=(15)   poll_slow_period=(60)
+        self.__transport = None
+        self.__registry = None
+        self.__params = None
+        self.__written = {}   # Last acknowledged value and time of writing, for each point.
+        self.__tracking = set()   # Points which already have the TrackingSelector set in this session.
+        self.__poll_periods = None
+        self.__read_state = {}   # Last good value of each polled point...
+        self.__read_times = {}   # and when it was read.
 
     @property
     def config_path(self):
@@ -87,7 +282,57 @@ class Climatix(object):
 
     @config.setter
     def config(self, config: dict):
+        changed = changed_keys(self.__config, config)
         self.__config = config
+        # Model parameters are compiled again only when they've changed. Same for the communication - any other change
+        # (credentials, pool sizes, point references, deadbands) rebuilds the transport and the registry on the next
+        # request, and all points are written again.
+        if len(changed & set(AHU_KEYS)) > 0:
+            self.__params = None
+        if len(changed - set(AHU_KEYS)) > 0:
+            if self.__transport is not None:
+                self.__transport.close()
+            self.__transport = None
+            self.__registry = None
+            self.__written = {}
+            self.__tracking = set()
+            self.__poll_periods = None
+            self.__read_state = {}
+            self.__read_times = {}
+
+    @property
+    def params(self):
+        if self.__params is None:
+            self.initialize_params()
+        return self.__params
+
+    # Should be called right after the config is loaded, so that a broken config stops the script at startup.
+    def initialize_params(self) -> bool:
+        self.__params = ahu_params(self.__config, self.__config_path)
+        return True
+
+    # Persistent session for this controller, created on first use. Authentication is attached to the session once
+    # and every request goes through the controller's circuit breaker.
+    @property
+    def transport(self):
+        if self.__transport is None:
+            breaker = CircuitBreaker(endpoint_name(self.__config["climatix_url"]),
+                                     int(self.__config.get("breaker_failures", 3)),
+                                     self.__config.get("breaker_delay", 1.0),
+                                     self.__config.get("breaker_max_delay", 60.0),
+                                     site=self.__site)
+            self.__transport = Transport(pool_connections=int(self.__config.get("pool_connections", 1)),
+                                         pool_maxsize=int(self.__config.get("pool_maxsize", 1)),
+                                         auth=self.climatix_auth(),
+                                         breaker=breaker)
+        return self.__transport
+
+    # Data point registry, compiled from the configuration on first use.
+    @property
+    def registry(self):
+        if self.__registry is None:
+            self.__registry = PointRegistry(self.__config)
+        return self.__registry
 
     def climatix_auth(self):
         climatix_auth = (self.__config["climatix_name"], self.__config["climatix_pass"])
@@ -95,46 +340,82 @@ class Climatix(object):
 
     # This function prepares the content of request to JSONGEN interface.
     def climatix_params_r(self, ao_list: list) -> dict:   # The input must be a list of keys from __config dictionary.
-        climatix_params = {"fn": "read"}   # Uses READ function.
-        params_list = []
-        for key in ao_list:
-            params_list.append(self.__config[key] + self.__config["present_val"])
-        climatix_params.update({"oa": params_list})
-        climatix_params.update({"pin": self.__config["climatix_pin"]})
-        return climatix_params
+        return self.registry.read_params(ao_list)   # Uses READ function, the request is prebuilt by the registry.
 
     # This function performs the actual reading request to JSONGEN interface.
-    def read_json(self, ao_list: list) -> dict:   # The input ao_list is passed directly to...
-        output = {}
+    def read_json(self, ao_list: list, output=None):   # The input ao_list is passed directly to...
+        if output is None:   # With output given (the simulation state), values are written right into it.
+            output = {}
         climatix_params = self.climatix_params_r(ao_list)   # the function, which prepares the content of the request.
+        error = "NONE"
         try:
-            climatix_get = requests.get(
+            climatix_get = self.transport.get(
                 self.__config["climatix_url"],
-                auth=self.climatix_auth(),
                 params=climatix_params,
                 timeout=0.750)   # This is ordinary GET request. Usually Climatix responds quickly, but check timeouts.
+        except CircuitOpenError:
+            error = "get_rd_open"   # Controller is known to be down, nothing was sent.
         except requests.Timeout:
-            output = {"error": "get_rd_tout"}
+            error = "get_rd_tout"
         except requests.ConnectionError:
-            output = {"error": "get_rd_conn"}
+            error = "get_rd_conn"
         except:
-            output = {"error": "get_rd_othr"}
+            error = "get_rd_othr"
         else:
             if climatix_get.status_code == 200:
-                received = climatix_get.json()["values"]
-                for cnt, key in enumerate(received):
-                    if type(received[key]) == list:
-                        output.update({ao_list[cnt]: received[key][0]})
-                    else:
-                        output.update({ao_list[cnt]: received[key]})
+                self.registry.decode(climatix_get.json()["values"], output)
             else:
-                output = {"error": "get_rd_" + str(climatix_get.status_code)}
+                error = "get_rd_" + str(climatix_get.status_code)
+        if error != "NONE":
+            output["error"] = error
+            metrics.count_error(error)
         return output   # When output is bad, it contains "error" key. This is recognized by other parts of the code
                         # and the faulty data is ignored. Script can carry old, good values and stay alive for some
                         # period of time. At least is't not crashing at single wrong response of the controller.
 
+    @property
+    def poll_periods(self):
+        if self.__poll_periods is None:
+            self.__poll_periods = poll_periods(self.__config)
+        return self.__poll_periods
+
+    @property
+    def read_state(self):
+        return self.__read_state
+
+    # Multi-rate reading. Takes the same ao_list as read_json, but requests only the points which are due by their
+    # polling class, so binary commands aren't asked for every few seconds while the positions are. The received
+    # values are merged into the cached read state and the output gets all the points of ao_list from it. Points of
+    # a failed request stay due, so they're asked for again next time. Returns the output, with "error" if the read
+    # failed, exactly like read_json.
+    def read_due(self, ao_list: list, output=None):
+        if output is None:
+            output = {}
+        now = self.__clock.time()
+        periods = self.poll_periods
+        # A little is tolerated (a tenth of the period, at most half a second), so a point with the same period as
+        # the tick isn't skipped every other time because of a few milliseconds of jitter.
+        due = []
+        for key in ao_list:
+            period = periods.get(key, 0.0)
+            if key not in self.__read_times or now - self.__read_times[key] >= period - min(period / 10, 0.5):
+                due.append(key)
+        if len(due) > 0:
+            received = self.read_json(due)
+            if "error" in received.keys():
+                output["error"] = received["error"]
+            else:
+                self.__read_state.update(received)
+                for key in due:
+                    self.__read_times.update({key: now})
+        for key in ao_list:
+            if key in self.__read_state:
+                output[key] = self.__read_state[key]
+        return output
+
     # This function prepares the content of request to JSONGEN interface.
-    def climatix_params_w(self, ao_dict: dict) -> dict:   # The input must be a dict with keys from __config dictionary.
+    def climatix_params_w(self, ao_dict: dict, tracking_set=()) -> dict:   # The input must be a dict with keys from
+                                                                           # __config dictionary.
         # The ao_dict input dictionary has values of list type, a two-element list where element [0] is a value, which
         # will be sent and the element [1] is a selector of send mode.
         # Mode 0: set 0x3040 TrackingSelector = COM and write the value to 0x3043 TrackingValueCOM member
@@ -142,28 +423,18 @@ class Climatix(object):
         # Mode 2: write to 0x3049 OffsetCorrectionApl member
         # Mode 0 is good for inputs, Mode 1 is good for setpoints and Mode 2 is a workaround for analog inputs which
         # do not allow for changing the TrackingSelector (the case of hardcoded AirQuality input in StdAHU V4.10.010)
-        climatix_params = {"fn": "write"}   # Uses WRITE function.
-        params_list = []
-        for key in ao_dict:
-            if ao_dict[key][1] == 1:
-                params_list.append(self.__config[key] + self.__config["present_val"] + ";" + str(ao_dict[key][0]))
-            elif ao_dict[key][1] == 2:
-                params_list.append(self.__config[key] + self.__config["offset_corr_apl"] + ";" + str(ao_dict[key][0]))
-            else:
-                params_list.append(self.__config[key] + self.__config["tracking_sel"] + ";" + "1")
-                params_list.append(self.__config[key] + self.__config["tracking_com_val"] + ";" + str(ao_dict[key][0]))
-        climatix_params.update({"oa": params_list})
-        climatix_params.update({"pin": self.__config["climatix_pin"]})
-        return climatix_params
+        # Keys given in tracking_set already have the TrackingSelector set, so in mode 0 only the value is written.
+        return self.registry.write_params(ao_dict, tracking_set)   # Uses WRITE function, prebuilt by the registry.
 
     # This function performs the actual writing request to JSONGEN interface.
-    def write_json(self, ao_dict: dict) -> dict:   # The input ao_dict is passed directly to...
+    def write_json(self, ao_dict: dict, tracking_set=()) -> dict:   # The input ao_dict is passed directly to...
         try:
-            climatix_get = requests.get(
+            climatix_get = self.transport.get(
                 self.__config["climatix_url"],
-                auth=self.climatix_auth(),
-                params=self.climatix_params_w(ao_dict),   # the function, which prepares the content of the request.
+                params=self.climatix_params_w(ao_dict, tracking_set),   # the function, which prepares the content of the request.
                 timeout=0.750)   # This is ordinary GET request. Usually Climatix responds quickly, but check timeouts.
+        except CircuitOpenError:
+            output = {"error": "get_wr_open"}
         except requests.Timeout:
             output = {"error": "get_wr_tout"}
         except requests.ConnectionError:
@@ -175,104 +446,141 @@ class Climatix(object):
                 output = climatix_get.json()
             else:
                 output = {"error": "get_wr_" + str(climatix_get.status_code)}
+        metrics.count_error(output.get("error", "NONE"))
         return output
         # When output is bad, it contains "error" key. This is recognized by other parts of the code and the faulty
         # data is ignored. Script can carry old, good values and stay alive for some period of time. At least is't not
         # crashing at single wrong response of the controller.
 
-    def calculate(self, op_data: dict) -> dict:
+    # Report-by-exception writing. Takes the same ao_dict as write_json, but sends only the points which moved outside
+    # their deadband since the last acknowledged write, or which weren't written for integrity_period seconds.
+    # In mode 0 the TrackingSelector is set once per session (and again with every integrity write, in case
+    # the controller was restarted in the meantime). Returns {} when there was nothing to send.
+    def write_changed(self, ao_dict: dict) -> dict:
+        now = self.__clock.time()
+        integrity_period = self.__config.get("integrity_period", 60.0)
+        to_write = {}
+        for key in ao_dict:
+            if key in self.__written:
+                last_value, last_time = self.__written[key]
+                if now - last_time >= integrity_period:
+                    self.__tracking.discard(key)
+                elif abs(ao_dict[key][0] - last_value) <= self.__config.get("deadband_" + key,
+                                                                              self.__config.get("deadband", 0.0)):
+                    continue
+            to_write.update({key: ao_dict[key]})
+        if len(to_write) == 0:
+            return {}
+        output = self.write_json(to_write, self.__tracking)
+        if "error" in output.keys():
+            # Nothing is acknowledged and the session is considered lost, so the selectors are set again next time.
+            self.__tracking = set()
+        else:
+            for key in to_write:
+                self.__written.update({key: (to_write[key][0], now)})
+                if to_write[key][1] not in (1, 2):
+                    self.__tracking.add(key)
+        return output
+
+    def calculate(self, op_data) -> dict:
+        # The model works on OpData in place. A plain dict is still accepted, then the results are only returned.
+        if type(op_data) == dict:
+            op_data = OpData(op_data)
+        params = self.params
         # CALCULATION OF FAN SPEED AND AIR VOLUME
         # Fan flow should be delivered when (1) dampers are opened or (2) fan step is received or (3) fan analog output
         # is activated. All those are managed when available.
         flow_sup_demand = 0.0
-        if "damp_cmd" in op_data.keys():
-            if op_data["damp_cmd"]:
-                if "fan_su_pos" in op_data.keys():
-                    flow_sup_demand = self.__config["ahu_vol"] * 1/100 * op_data["fan_su_pos"]
-                elif "fan_su_cmd" in op_data.keys():
-                    if op_data["fan_su_cmd"] == 0:
+        if op_data.available("damp_cmd"):
+            if op_data.damp_cmd:
+                if op_data.available("fan_su_pos"):
+                    flow_sup_demand = params.flow_per_pos * op_data.fan_su_pos
+                elif op_data.available("fan_su_cmd"):
+                    if op_data.fan_su_cmd == 0:
                         flow_sup_demand = 0.0
-                    elif op_data["fan_su_cmd"] == 1:
-                        flow_sup_demand = self.__config["ahu_vol"] * 2/3
-                    elif op_data["fan_su_cmd"] == 2:
-                        flow_sup_demand = self.__config["ahu_vol"] * 3/3
+                    elif op_data.fan_su_cmd == 1:
+                        flow_sup_demand = params.flow_step_1
+                    elif op_data.fan_su_cmd == 2:
+                        flow_sup_demand = params.ahu_vol
                 else:
-                    flow_sup_demand = self.__config["ahu_vol"]
+                    flow_sup_demand = params.ahu_vol
             else:
                 flow_sup_demand = 0.0
         else:
-            if "fan_su_pos" in op_data.keys():
-                flow_sup_demand = self.__config["ahu_vol"] * 1/100 * op_data["fan_su_pos"]
-            elif "fan_su_cmd" in op_data.keys():
-                if op_data["fan_su_cmd"] == 0:
+            if op_data.available("fan_su_pos"):
+                flow_sup_demand = params.flow_per_pos * op_data.fan_su_pos
+            elif op_data.available("fan_su_cmd"):
+                if op_data.fan_su_cmd == 0:
                     flow_sup_demand = 0.0
-                elif op_data["fan_su_cmd"] == 1:
-                    flow_sup_demand = self.__config["ahu_vol"] * 2/3
-                elif op_data["fan_su_cmd"] == 2:
-                    flow_sup_demand = self.__config["ahu_vol"] * 3/3
+                elif op_data.fan_su_cmd == 1:
+                    flow_sup_demand = params.flow_step_1
+                elif op_data.fan_su_cmd == 2:
+                    flow_sup_demand = params.ahu_vol
             else:
                 flow_sup_demand = 0.0
         # Well, actually we just calculated, what the flow_sup SHOULD BE but we don't apply that directly to air flow
         # calculation. This would generate jumps and oscillations between this simulation script and controller's res-
         # ponse. To solve this problem, this demand is gradually applied to volumetric flow parameter - it's simulation
         # of fan's inertia without complex mechanics and fluid modelling.
-        flow_su = follow_demand(flow_sup_demand, op_data["flow_su"], 100.0)
+        flow_su = follow_demand(flow_sup_demand, op_data.flow_su, 100.0)
         flow_ex = flow_su
         # Additionally, air velocity in the AHU is calculated. It's proportional to flow values.
-        speed_su = self.__config["ahu_spd"] * flow_su / self.__config["ahu_vol"]
-        speed_ex = self.__config["ahu_spd"] * flow_ex / self.__config["ahu_vol"]
+        speed_su = params.speed_per_flow * flow_su
+        speed_ex = params.speed_per_flow * flow_ex
+        # Heat capacity of the air flows [kW/K], used by all the power and temperature calculations below.
+        heat_cap_su = AIR_HEAT_CAPACITY * flow_su
+        heat_cap_ex = AIR_HEAT_CAPACITY * flow_ex
 
         # CALCULATION OF HEATING POWER
         # Heating power should be delivered when (1) the heater is available, (2) the valve is open (mandatory)
         # and (3) the pump is running (optional).
-        if "htg_pos" in op_data.keys():
-            if "pump_cmd" in op_data.keys():
-                if op_data["pump_cmd"]:
-                    htg_pwr_demand = self.__config["ahu_htg"] * 1/100 * op_data["htg_pos"]
+        if op_data.available("htg_pos"):
+            if op_data.available("pump_cmd"):
+                if op_data.pump_cmd:
+                    htg_pwr_demand = params.htg_per_pos * op_data.htg_pos
                 else:
                     htg_pwr_demand = 0.0
             else:
-                htg_pwr_demand = self.__config["ahu_htg"] * 1/100 * op_data["htg_pos"]
+                htg_pwr_demand = params.htg_per_pos * op_data.htg_pos
         else:
             htg_pwr_demand = 0.0
         # Then the heating power must follow the demand, but with appropriate inertia as previously.
-        htg_pwr = follow_demand(htg_pwr_demand, op_data["htg_pwr"])
+        htg_pwr = follow_demand(htg_pwr_demand, op_data.htg_pwr)
 
         # CALCULATION OF COOLING POWER
         # Cooling power should be delivered when (1) the cooler is available, (2) the valve is open (mandatory)
         # and (3) the pump is running (optional).
-        if "clg_pos" in op_data.keys():
-            if "clg_cmd" in op_data.keys():
-                if op_data["clg_cmd"]:
-                    clg_pwr_demand = self.__config["ahu_clg"] * 1/100 * op_data["clg_pos"]
+        if op_data.available("clg_pos"):
+            if op_data.available("clg_cmd"):
+                if op_data.clg_cmd:
+                    clg_pwr_demand = params.clg_per_pos * op_data.clg_pos
                 else:
                     clg_pwr_demand = 0.0
             else:
-                clg_pwr_demand = self.__config["ahu_clg"] * 1/100 * op_data["clg_pos"]
+                clg_pwr_demand = params.clg_per_pos * op_data.clg_pos
         else:
             clg_pwr_demand = 0.0
         # As previously, the cooling demand is gradually applied to cooling power output.
-        clg_pwr = follow_demand(clg_pwr_demand, op_data["clg_pwr"])
+        clg_pwr = follow_demand(clg_pwr_demand, op_data.clg_pwr)
 
         # CALCULATION OF HEAT RECOVERY POWER
         # HREC power should be delivered when (1) the heat recovery is available, (2) the control signal is applied
         # and (3) relevant parameters are available: temp, temp_extr, air flow (all conditions are mandatory).
-        if "hrec_pos" in op_data.keys():
-            temp_diff = op_data["temp_ex"] - op_data["temp"]
+        if op_data.available("hrec_pos"):
+            temp_diff = op_data.temp_ex - op_data.temp
             if -2.0 < temp_diff < 2.0:
                 hrec_pwr_demand = 0.0
             else:
-                hrec_pwr_demand = self.__config["hrec_eff"] * temp_diff *\
-                                  (flow_su / 3600 * 1.2 * 1005) / 1000 * 1/100 * op_data["hrec_pos"]
+                hrec_pwr_demand = params.hrec_per_pos * temp_diff * heat_cap_su * op_data.hrec_pos
         else:
             hrec_pwr_demand = 0.0
         # As one could expect, demand must be gradually transformed into hrec power.
-        hrec_pwr = follow_demand(hrec_pwr_demand, op_data["hrec_pwr"])
+        hrec_pwr = follow_demand(hrec_pwr_demand, op_data.hrec_pwr)
         # HREC operation takes energy from extract air and alters exhaust temperature. This is calculated here.
         if flow_ex == 0.0:
-            temp_eh = op_data["temp_ex"]
+            temp_eh = op_data.temp_ex
         else:
-            temp_eh = op_data["temp_ex"] - hrec_pwr * 1000 / (flow_ex / 3600 * 1.2 * 1005)
+            temp_eh = op_data.temp_ex - hrec_pwr / heat_cap_ex
         # And in case of extreme values, which can occur in transient conditions, temp_eh is limited to
         # relevant range
         if temp_eh > 50.0:
@@ -282,9 +590,9 @@ class Climatix(object):
 
         # Finally, from flow and all heat/cool sources, the output AHU parameters are calculated.
         if flow_su == 0.0:
-            temp_su = op_data["temp_rm"]
+            temp_su = op_data.temp_rm
         else:
-            temp_su = op_data["temp"] + (hrec_pwr + htg_pwr - clg_pwr) * 1000 / (flow_su / 3600 * 1.2 * 1005)
+            temp_su = op_data.temp + (hrec_pwr + htg_pwr - clg_pwr) / heat_cap_su
         # And in case of extreme values, which can occur in transient conditions, temp_su is limited to
         # relevant range
         if temp_su > 50.0:
@@ -294,7 +602,7 @@ class Climatix(object):
 
         # CALCULATION OF DUST DEPOSIT AND RESULTING FILTER PRESSURE DROP
         # Dust deposit is simple accumulation, depending on dust measures from API and air flow in the AHU.
-        dust_depo = op_data["dust_depo"] + dust_increase(op_data["dust"], op_data["flow_su"], op_data["ti_diff"])
+        dust_depo = op_data.dust_depo + dust_increase(op_data.dust, op_data.flow_su, op_data.ti_diff)
         # Filter pressure drop is described as f(x) ~ ⅓ξx²+ξx where x is air velocity in the filter fabrics and
         # ξ is local drag coefficient, proportional (but non-linear...?) to dust deposit.
         # Filter window can be ~15% narrower than the full AHU area - due to construction that supports filter pads.
@@ -306,6 +614,17 @@ class Climatix(object):
         filt_ex_pres = filter_curve(dust_depo, speed_ex)
         print("flow_su: {:.5}, temp_su: {:.4}, temp_eh: {:.4}, hrec_pwr: {:.4}, htg_pwr: {:.4}, clg_pwr: {:.4}, dust_depo: {:.6}".
               format(flow_su, temp_su, temp_eh, hrec_pwr, htg_pwr, clg_pwr, dust_depo))
+        # Results go straight into the state, the returned dict is for callers which want to see them separately.
+        op_data.flow_su = flow_su
+        op_data.flow_ex = flow_ex
+        op_data.temp_su = temp_su
+        op_data.temp_eh = temp_eh
+        op_data.hrec_pwr = hrec_pwr
+        op_data.htg_pwr = htg_pwr
+        op_data.clg_pwr = clg_pwr
+        op_data.dust_depo = dust_depo
+        op_data.filt_su_pres = filt_su_pres
+        op_data.filt_ex_pres = filt_ex_pres
         return {"flow_su": flow_su, "flow_ex": flow_ex, "temp_su": temp_su, "temp_eh": temp_eh, "hrec_pwr": hrec_pwr,
                 "htg_pwr": htg_pwr, "clg_pwr": clg_pwr, "dust_depo": dust_depo, "filt_su_pres": filt_su_pres,
                 "filt_ex_pres": filt_ex_pres}
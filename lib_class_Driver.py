@@ -0,0 +1,116 @@
+# packages
+from concurrent.futures import ThreadPoolExecutor, wait
+from lib_class_Metrics import metrics
+
+
+# defs
+# These are the control signals read from every controller, the same as in simulator.py. Each tick asks only for those
+# which are due by their polling class (see Climatix.read_due).
+READ_LIST = ["damp_cmd",
+             "fan_su_cmd",
+             "fan_su_pos",
+             "fan_ex_cmd",
+             "fan_ex_pos",
+             "hrec_pos",
+             "pump_cmd",
+             "htg_pos",
+             "clg_cmd",
+             "clg_pos"]
+
+
+# Standard read -> model -> write cycle for one controller with the simplified building model. It works on the site's
+# own op_data (OpData or a plain dict), which every stage updates in place. Any other callable taking op_data can be
+# used as a cycle as well.
+# When the site has its own Ambient, outside conditions are taken from it, otherwise they come with the tick.
+# Durations of the stages are recorded in the metrics under the site's name.
+def climatix_cycle(controls, building, ambient=None, site=""):
+    def cycle(op_data):
+        if ambient is not None:
+            with metrics.phase("ambient", site):
+                ambient.simulate(op_data)
+        with metrics.phase("read_json", site):
+            controls.read_due(READ_LIST, op_data)
+        with metrics.phase("building", site):
+            building.calculate(op_data)
+        with metrics.phase("calculate", site):
+            controls.calculate(op_data)
+        with metrics.phase("write_json", site):
+            status = controls.write_changed({"temp": [op_data["temp"], 0],
+                                             "temp_su": [op_data["temp_su"], 0],
+                                             "temp_rm": [op_data["temp_rm"], 0],
+                                             "temp_ex": [op_data["temp_ex"], 0],
+                                             "temp_eh": [op_data["temp_eh"], 0],
+                                             "flow_su": [op_data["flow_su"], 0],
+                                             "flow_ex": [op_data["flow_ex"], 0],
+                                             "filt_su_pres": [op_data["filt_su_pres"], 0],
+                                             "filt_ex_pres": [op_data["filt_ex_pres"], 0],
+                                             "air_q": [op_data["air_q"], 0]})
+        if "error" in status.keys():
+            op_data["error"] = status["error"]
+        return op_data
+    return cycle
+
+
+# Driver for many controllers from one process. Every site has its own cycle and its own op_data, and all the cycles
+# of one tick run at once in a bounded thread pool - so the tick takes as long as the slowest single exchange, not
+# the sum of all of them. A site which fails or hangs doesn't affect the others: its error is recorded and, while its
+# previous cycle is still running, it's simply skipped.
+class Driver(object):
+    def __init__(self, workers=8, timeout=2.500):
+        self.__workers = workers
+        self.__timeout = timeout   # How long a tick waits for the cycles [s], should be less than the tick step.
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="driver")
+        self.__sites = {}
+
+    @property
+    def sites(self):
+        return self.__sites
+
+    def add_site(self, name: str, cycle, op_data: dict) -> bool:
+        self.__sites.update({name: {"cycle": cycle, "op_data": op_data, "future": None}})
+        return True
+
+    def op_data(self, name: str) -> dict:
+        return self.__sites[name]["op_data"]
+
+    # The shared dict carries values common to all sites, e.g. ambient conditions or ti_diff.
+    def tick(self, shared: dict) -> dict:
+        statuses = {}
+        futures = {}
+        for name in self.__sites:
+            site = self.__sites[name]
+            if site["future"] is not None and not site["future"].done():
+                statuses.update({name: {"error": "drv_busy"}})
+                metrics.count_error("drv_busy")
+                continue
+            site["future"] = self.__executor.submit(self.run_site, site, shared)
+            futures.update({site["future"]: name})
+        done, not_done = wait(futures.keys(), timeout=self.__timeout)
+        for future in done:
+            statuses.update({futures[future]: future.result()})
+        for future in not_done:
+            statuses.update({futures[future]: {"error": "drv_tout"}})
+            metrics.count_error("drv_tout")
+        return statuses
+
+    @staticmethod
+    def run_site(site: dict, shared: dict) -> dict:
+        op_data = site["op_data"]
+        for key in shared:
+            op_data[key] = shared[key]
+        try:
+            site["cycle"](op_data)
+        except Exception as exception:
+            status = {"error": "drv_" + type(exception).__name__}
+            metrics.count_error(status["error"])
+        else:
+            if "error" in op_data:
+                status = {"error": op_data["error"]}
+            else:
+                status = {"error": "NONE"}
+        return status
+
+    # Cycles which haven't started yet are cancelled, the running ones are left to finish on their own.
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        return True
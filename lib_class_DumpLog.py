@@ -0,0 +1,231 @@
+# packages
+import argparse
+import datetime
+import glob
+import numpy as np
+
+
+# defs
+# Loader of the dump_YYMMDD_HHMM.txt files written by Handler.dump_to_file. Every line of a dump is
+# "YYYY.MM.DD HH:MM;key=value;key=value;..." - floats with 3 decimals, bools as True/False and, when there was a
+# communication problem, an error=<code> field somewhere in between. The key set may change between files (and even
+# between lines, e.g. after a restart with a newer simulator), so columns are matched by name, not by position.
+#
+# Files are read line by line and converted into NumPy arrays chunk after chunk, so even a long multi-site archive
+# is never held in memory as text. In every chunk:
+# time - float64, Unix time of the line (local time, as written by the simulator)
+# bool channels - bool arrays, missing values are False
+# error - string array, "" where the line had no error
+# other channels - float64 arrays, missing values are NaN
+BOOL_VALUES = {"True": True, "False": False}
+# Dumps of the single-site simulators. The multi-site one writes dump_<site>_YYMMDD_HHMM.txt, which a plain
+# "dump_*.txt" would mix in - its sites are selected with their own pattern, e.g. "dump_north_[0-9]*.txt".
+DUMP_PATTERN = "dump_[0-9][0-9][0-9][0-9][0-9][0-9]_[0-9][0-9][0-9][0-9].txt"
+
+
+# All dump files matching the pattern, oldest first. The name carries the start time of the script, so sorting by
+# name gives the order of restarts.
+def dump_files(pattern=DUMP_PATTERN) -> list:
+    return sorted(glob.glob(pattern))
+
+
+def parse_time(text: str) -> float:
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                             int(text[11:13]), int(text[14:16])).timestamp()
+
+
+def parse_line(line: str):
+    fields = line.rstrip("\n").split(";")
+    values = {}
+    for field in fields[1:]:
+        key, separator, value = field.partition("=")
+        if separator == "":
+            continue
+        if key == "error":
+            values.update({key: value})
+        elif value in BOOL_VALUES:
+            values.update({key: BOOL_VALUES[value]})
+        else:
+            try:
+                values.update({key: float(value)})
+            except ValueError:
+                values.update({key: float("nan")})
+    return parse_time(fields[0]), values
+
+
+def chunk_arrays(times: list, rows: list, channels=None) -> dict:
+    names = {}
+    for row in rows:
+        for key in row:
+            if channels is None or key in channels:
+                names.setdefault(key, type(row[key]))
+    chunk = {"time": np.array(times, dtype=np.float64)}
+    for key in names:
+        if key == "error":
+            chunk.update({key: np.array([row.get(key, "") for row in rows], dtype=str)})
+        elif names[key] == bool:
+            chunk.update({key: np.array([bool(row.get(key, False)) for row in rows], dtype=bool)})
+        else:
+            chunk.update({key: np.array([row.get(key, np.nan) for row in rows], dtype=np.float64)})
+    return chunk
+
+
+# Dump files as a stream of chunks (dicts of arrays), limited to the time range [start, end) and to the given
+# channels. Lines which can't be parsed (e.g. cut off by a crash) are skipped.
+def read_dump_chunks(file_paths, channels=None, start=None, end=None, chunk_lines=10000):
+    if type(file_paths) == str:
+        file_paths = [file_paths]
+    times = []
+    rows = []
+    for file_path in file_paths:
+        dump_file = open(file_path, mode="r")
+        for line in dump_file:
+            try:
+                timestamp, values = parse_line(line)
+            except ValueError:
+                continue
+            if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                continue
+            times.append(timestamp)
+            rows.append(values)
+            if len(rows) >= chunk_lines:
+                yield chunk_arrays(times, rows, channels)
+                times = []
+                rows = []
+        dump_file.close()
+    if len(rows) > 0:
+        yield chunk_arrays(times, rows, channels)
+
+
+# All the selected data at once, one array per channel. A channel which is missing in some chunks is filled up
+# the same way as inside a chunk.
+def load_dumps(file_paths, channels=None, start=None, end=None) -> dict:
+    chunks = list(read_dump_chunks(file_paths, channels, start, end))
+    names = {}
+    for chunk in chunks:
+        for key in chunk:
+            names.setdefault(key, chunk[key].dtype)
+    output = {}
+    for key in names:
+        parts = []
+        for chunk in chunks:
+            if key in chunk:
+                parts.append(chunk[key])
+            elif key == "error":
+                parts.append(np.full(len(chunk["time"]), "", dtype=str))
+            elif names[key] == bool:
+                parts.append(np.zeros(len(chunk["time"]), dtype=bool))
+            else:
+                parts.append(np.full(len(chunk["time"]), np.nan))
+        if len(parts) > 0:
+            output.update({key: np.concatenate(parts)})
+    return output
+
+
+# Relative accuracy of the percentiles of aggregate_dumps: each one is within 1 % of a value in the data.
+PERCENTILE_ACCURACY = 0.01
+
+
+# Running aggregate of one channel in one interval - count, min, max, sum (for the mean) and a histogram with
+# logarithmic bins for the percentiles. A bin covers the values from gamma^(i-1) to gamma^i (and the same for negative
+# values), so its middle is within the accuracy of every value in it. The size depends on the range of the values, not
+# on their number - a few hundred bins at most for a whole year of a channel - and two aggregates of the same interval
+# can be merged by adding up the counts, so data may come in any order.
+class ChannelStats(object):
+    def __init__(self, accuracy=PERCENTILE_ACCURACY):
+        self.__gamma = (1 + accuracy) / (1 - accuracy)
+        self.__count = 0
+        self.__min = np.inf
+        self.__max = -np.inf
+        self.__sum = 0.0
+        self.__bins = {}   # (sign, sign * bin index) -> count, sorted keys give the order of the values
+
+    @property
+    def count(self):
+        return self.__count
+
+    # data - float array without NaNs
+    def add(self, data) -> bool:
+        if len(data) == 0:
+            return True
+        self.__count = self.__count + len(data)
+        self.__min = min(self.__min, float(data.min()))
+        self.__max = max(self.__max, float(data.max()))
+        self.__sum = self.__sum + float(data.sum())
+        signs = np.sign(data).astype(np.int64)
+        magnitudes = np.abs(data)
+        indexes = np.zeros(len(data), dtype=np.int64)
+        non_zero = magnitudes > 0
+        indexes[non_zero] = np.ceil(np.log(magnitudes[non_zero]) / np.log(self.__gamma)).astype(np.int64)
+        keys, counts = np.unique(np.stack((signs, signs * indexes), axis=1), axis=0, return_counts=True)
+        for key, count in zip(keys, counts):
+            key = (int(key[0]), int(key[1]))
+            self.__bins.update({key: self.__bins.get(key, 0) + int(count)})
+        return True
+
+    # Value at the given rank (0 ... count - 1), estimated from the middle of its bin.
+    def value_at(self, rank: float) -> float:
+        seen = 0
+        for sign, signed_index in sorted(self.__bins):
+            seen = seen + self.__bins[(sign, signed_index)]
+            if seen > rank:
+                value = sign * 2 * self.__gamma ** (sign * signed_index) / (self.__gamma + 1)
+                return min(max(value, self.__min), self.__max)
+        return self.__max
+
+    def summary(self, percentiles) -> dict:
+        if self.__count == 0:
+            return {"count": 0}
+        stats = {"count": self.__count, "min": self.__min, "max": self.__max, "mean": self.__sum / self.__count}
+        for percentile in percentiles:
+            stats.update({"p{}".format(percentile): self.value_at(percentile / 100 * (self.__count - 1))})
+        return stats
+
+
+# Min, max, mean and percentiles of the channels in fixed intervals (e.g. 3600 for hourly). The files may overlap
+# or come out of order (e.g. after the clock was set back), so every chunk is folded into the running aggregates
+# (ChannelStats) of its intervals, and every interval is yielded once, in order, after the last file. No samples are
+# kept - the memory depends on the number of intervals and channels, not on the amount of data. Only the selected
+# channels are aggregated, never the text. NaNs are left out; bools are aggregated as 0/1, which makes the mean a
+# duty cycle. The percentiles are estimated within PERCENTILE_ACCURACY.
+# Yields (interval start, {channel: {"count", "min", "max", "mean", "p<N>"...}}).
+def aggregate_dumps(file_paths, channels, interval=3600.0, start=None, end=None, percentiles=(50, 95)):
+    buckets = {}
+    for chunk in read_dump_chunks(file_paths, channels, start, end):
+        bucket_index = np.floor(chunk["time"] / interval).astype(np.int64)
+        for bucket in np.unique(bucket_index):
+            mask = bucket_index == bucket
+            stats = buckets.setdefault(int(bucket), {})
+            for key in channels:
+                if key in chunk and key != "error":
+                    data = chunk[key][mask].astype(np.float64)
+                    stats.setdefault(key, ChannelStats()).add(data[~np.isnan(data)])
+    for bucket in sorted(buckets):
+        stats = buckets.pop(bucket)
+        yield bucket * interval, {key: stats[key].summary(percentiles) for key in stats}
+
+
+# Query tool, e.g.: python lib_class_DumpLog.py "dump_[0-9]*.txt" temp_rm,htg_pos --start "2024.01.08 00:00"
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate simulator dump files.")
+    parser.add_argument("pattern", help="dump files, e.g. dump_[0-9]*.txt, or dump_<site>_[0-9]*.txt of one site")
+    parser.add_argument("channels", help="comma separated channel names")
+    parser.add_argument("--interval", type=float, default=3600.0, help="interval length [s]")
+    parser.add_argument("--start", default=None, help="YYYY.MM.DD HH:MM")
+    parser.add_argument("--end", default=None, help="YYYY.MM.DD HH:MM")
+    arguments = parser.parse_args()
+    start = parse_time(arguments.start) if arguments.start is not None else None
+    end = parse_time(arguments.end) if arguments.end is not None else None
+    channels = arguments.channels.split(",")
+    for interval_start, summary in aggregate_dumps(dump_files(arguments.pattern), channels, arguments.interval,
+                                                   start, end):
+        line = datetime.datetime.fromtimestamp(interval_start).strftime("%Y.%m.%d %H:%M")
+        for key in channels:
+            if key in summary and summary[key]["count"] > 0:
+                line = line + ";{}={:.3f}/{:.3f}/{:.3f}".format(key, summary[key]["min"], summary[key]["mean"],
+                                                                summary[key]["max"])
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# packages
+import numpy as np
+from lib_class_Building import transfer_efficiency
+from lib_class_Climatix import AIR_HEAT_CAPACITY, AhuParams, dust_increase, filter_curve
+from lib_class_other import Clock
+
+
+# defs
+# Array version of lib_class_Climatix.follow_demand, with the same inertia steps, applied element by element.
+def follow_demand_array(demand, value, step=1.0):
+    value = np.asarray(value, dtype=float)
+    output = np.select([value < (demand - step),
+                        value < (demand - step / 10),
+                        value > (demand + step),
+                        value > (demand + step / 10)],
+                       [value + step / 2,
+                        value + step / 20,
+                        value - step / 2,
+                        value - step / 20],
+                       demand)
+    return output
+
+
+# Both dust_increase and filter_curve are pure arithmetic, so they accept NumPy arrays as they are.
+dust_increase_array = dust_increase
+filter_curve_array = filter_curve
+
+
+# In the fleet, "the key is present in op_data" becomes a mask. When the key is missing from the inputs, the signal
+# is not available in any unit. When it's given, NaN entries mark units which don't have that signal.
+def available(op_data: dict, key: str, size: int):
+    if key in op_data.keys():
+        return ~np.isnan(np.broadcast_to(np.asarray(op_data[key], dtype=float), (size,)))
+    else:
+        return np.zeros(size, dtype=bool)
+
+
+def signal(op_data: dict, key: str, size: int):
+    if key in op_data.keys():
+        return np.broadcast_to(np.asarray(op_data[key], dtype=float), (size,))
+    else:
+        return np.full(size, np.nan)
+
+
+# Fleet version of the extended building model. Instead of one BuildingEx object and one op_data dict per site, the
+# state of N buildings is held in NumPy arrays and advanced in one batched step. The math is exactly the same as in
+# BuildingEx.power_delivery / calculate_layer / simulate_dioxide, so per-building results match the scalar path.
+# Each building must be configured and have its initialize_params() called before it's added to the fleet.
+class BuildingExFleet(object):
+    # These are the keys of op_data which belong to the building model. They are kept as arrays, one entry per site.
+    state_keys = ("air_AQ", "air_PB", "wall_AQ", "wall_PB", "ins_AQ", "ins_PB",
+                  "temp_rm", "temp_ex", "temp_wall", "temp_ins", "air_q")
+
+    def __init__(self, buildings: list, clock=None):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
+        self.__size = len(buildings)
+        # Constants characterizing every building, precomputed by BuildingEx.initialize_params().
+        self.__params = {}
+        for key in ("wall_C", "wall_HE", "window_SP", "air_C", "air_HE", "ins_C", "ins_HE", "air_spec_heat",
+                    "air_density", "building_vol"):
+            self.__params[key] = np.array([getattr(building.params, key) for building in buildings], dtype=float)
+        self.__state = {}
+        for key in self.state_keys:
+            self.__state[key] = np.zeros(self.__size, dtype=float)
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def params(self):
+        return self.__params
+
+    @property
+    def state(self):
+        return self.__state
+
+    # Initial state is taken from op_data dicts, one per building, in the same order as the buildings.
+    def load_state(self, op_data_list: list) -> bool:
+        for key in self.state_keys:
+            self.__state[key] = np.array([op_data[key] for op_data in op_data_list], dtype=float)
+        return True
+
+    # This returns the building part of op_data for a single site, ready to be merged into its op_data dict.
+    def site_state(self, index: int) -> dict:
+        output = {}
+        for key in self.state_keys:
+            output.update({key: float(self.__state[key][index])})
+        return output
+
+    def power_delivery(self, temp_su, flow_su, solar):
+        temp_delta = temp_su - self.__state["temp_rm"]
+        power = transfer_efficiency(temp_delta) * temp_delta * \
+                self.__params["air_spec_heat"] * self.__params["air_density"] * 1/3600 * flow_su + \
+                self.__params["window_SP"] * solar
+        return power
+
+    def calculate_layer(self, layer_name: str, ti_diff, power_source, temp_sink) -> dict:
+        key_c = layer_name + "_C"
+        key_he = layer_name + "_HE"
+        key_aq = layer_name + "_AQ"
+        key_pb = layer_name + "_PB"
+        accumulated_energy = self.__state[key_aq] + 0.0036 * self.__state[key_pb] * ti_diff
+        temp_layer = 1000000 * accumulated_energy / self.__params[key_he] - 273.15
+        power_sink = (temp_layer - temp_sink) * self.__params[key_c]
+        power_balance = power_source - power_sink
+        return {"AQ": accumulated_energy,
+                "PB": power_balance,
+                "power_sink": power_sink,
+                "temperature": temp_layer}
+
+    def simulate_dioxide(self, ti_diff, flow_su, preci, solar, dust):
+        activity = preci / 25 + solar / 250 + dust / 50
+        air_q = self.__state["air_q"]
+        if 7 <= int(self.__clock.strftime("%H")) <= 19:
+            # Same thresholds as in BuildingEx.simulate_dioxide, selected per building.
+            factor = np.select([air_q < 1000.0, air_q < 1250.0, air_q < 1500.0], [100.0, 70.0, 40.0], 20.0)
+            low = np.select([air_q < 1000.0, air_q < 1250.0, air_q < 1500.0], [50, 35, 20], 10)
+            high = np.select([air_q < 1000.0, air_q < 1250.0, air_q < 1500.0], [200, 140, 80], 40)
+        else:
+            factor = 10.0
+            low = 5
+            high = 20
+        number_of_people = np.clip(np.trunc(5 + factor * activity), low, high)
+        exhale_flow = number_of_people * 1200 * 0.0005
+        exhale_co2 = 40000.0
+        supply_co2 = 400.0
+        building_vol = self.__params["building_vol"]
+        carbon_dioxide = ((exhale_flow * exhale_co2 + flow_su * supply_co2) * ti_diff +
+                          (building_vol - (exhale_flow + flow_su) * ti_diff) * air_q) / building_vol
+        return carbon_dioxide
+
+    # One simulation step for the whole fleet. Inputs are arrays (or scalars, shared by all buildings) of the values,
+    # which the scalar path takes from op_data. The layers are calculated in the same order as in simulator_ex.py,
+    # thus each layer sees the neighbour's temperature from the previous step.
+    def step(self, ti_diff, temp_su, flow_su, temp, preci, solar, dust):
+        power_source = self.power_delivery(temp_su, flow_su, solar)
+        air_conditions = self.calculate_layer("air", ti_diff, power_source, self.__state["temp_wall"])
+        self.__state["air_AQ"] = air_conditions["AQ"]
+        self.__state["air_PB"] = air_conditions["PB"]
+        self.__state["temp_rm"] = air_conditions["temperature"]
+        self.__state["temp_ex"] = air_conditions["temperature"]
+        wall_conditions = self.calculate_layer("wall", ti_diff, air_conditions["power_sink"], self.__state["temp_ins"])
+        self.__state["wall_AQ"] = wall_conditions["AQ"]
+        self.__state["wall_PB"] = wall_conditions["PB"]
+        self.__state["temp_wall"] = wall_conditions["temperature"]
+        insulation_conditions = self.calculate_layer("ins", ti_diff, wall_conditions["power_sink"], temp)
+        self.__state["ins_AQ"] = insulation_conditions["AQ"]
+        self.__state["ins_PB"] = insulation_conditions["PB"]
+        self.__state["temp_ins"] = insulation_conditions["temperature"]
+        self.__state["air_q"] = self.simulate_dioxide(ti_diff, flow_su, preci, solar, dust)
+        return power_source
+
+
+# Fleet version of the AHU model from Climatix.calculate. Compiled parameters of every unit (Climatix.params, with
+# the same derived constants as the scalar model uses) are collected into arrays, then flows, powers, temperatures
+# and filter pressures for all units are calculated in one call. The availability branches of the scalar model are
+# replaced with masks, see available() above.
+class ClimatixFleet(object):
+    def __init__(self, units: list):
+        self.__size = len(units)
+        self.__params = {}
+        for key in AhuParams._fields:
+            self.__params[key] = np.array([getattr(unit.params, key) for unit in units], dtype=float)
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def params(self):
+        return self.__params
+
+    def calculate(self, op_data: dict) -> dict:
+        size = self.__size
+        ahu_vol = self.__params["ahu_vol"]
+        # CALCULATION OF FAN SPEED AND AIR VOLUME
+        damp_avail = available(op_data, "damp_cmd", size)
+        damp_open = signal(op_data, "damp_cmd", size) != 0.0
+        fan_pos_avail = available(op_data, "fan_su_pos", size)
+        fan_cmd_avail = available(op_data, "fan_su_cmd", size)
+        fan_su_cmd = signal(op_data, "fan_su_cmd", size)
+        flow_step = np.select([fan_cmd_avail & (fan_su_cmd == 1), fan_cmd_avail & (fan_su_cmd == 2)],
+                              [self.__params["flow_step_1"], ahu_vol], 0.0)
+        # Without any fan signal, the flow is nominal when the dampers are known to be open and zero otherwise.
+        flow_sup_demand = np.select([fan_pos_avail, fan_cmd_avail, damp_avail],
+                                    [self.__params["flow_per_pos"] * signal(op_data, "fan_su_pos", size), flow_step,
+                                     ahu_vol], 0.0)
+        flow_sup_demand = np.where(damp_avail & ~damp_open, 0.0, flow_sup_demand)
+        flow_su = follow_demand_array(flow_sup_demand, signal(op_data, "flow_su", size), 100.0)
+        flow_ex = flow_su
+        speed_su = self.__params["speed_per_flow"] * flow_su
+        speed_ex = self.__params["speed_per_flow"] * flow_ex
+        heat_cap_su = AIR_HEAT_CAPACITY * flow_su
+        heat_cap_ex = AIR_HEAT_CAPACITY * flow_ex
+
+        # CALCULATION OF HEATING POWER
+        htg_on = available(op_data, "htg_pos", size) & \
+            ~(available(op_data, "pump_cmd", size) & (signal(op_data, "pump_cmd", size) == 0.0))
+        htg_pwr_demand = np.where(htg_on, self.__params["htg_per_pos"] * signal(op_data, "htg_pos", size), 0.0)
+        htg_pwr = follow_demand_array(htg_pwr_demand, signal(op_data, "htg_pwr", size))
+
+        # CALCULATION OF COOLING POWER
+        clg_on = available(op_data, "clg_pos", size) & \
+            ~(available(op_data, "clg_cmd", size) & (signal(op_data, "clg_cmd", size) == 0.0))
+        clg_pwr_demand = np.where(clg_on, self.__params["clg_per_pos"] * signal(op_data, "clg_pos", size), 0.0)
+        clg_pwr = follow_demand_array(clg_pwr_demand, signal(op_data, "clg_pwr", size))
+
+        # CALCULATION OF HEAT RECOVERY POWER
+        temp = signal(op_data, "temp", size)
+        temp_ex = signal(op_data, "temp_ex", size)
+        temp_diff = temp_ex - temp
+        hrec_on = available(op_data, "hrec_pos", size) & ~((-2.0 < temp_diff) & (temp_diff < 2.0))
+        hrec_pwr_demand = np.where(hrec_on, self.__params["hrec_per_pos"] * temp_diff * heat_cap_su *
+                                   signal(op_data, "hrec_pos", size), 0.0)
+        hrec_pwr = follow_demand_array(hrec_pwr_demand, signal(op_data, "hrec_pwr", size))
+        # Zero flow is replaced with 1.0 in the denominator only to avoid warnings, those entries are not used anyway.
+        temp_eh = np.where(flow_ex == 0.0, temp_ex, temp_ex - hrec_pwr / np.where(flow_ex == 0.0, 1.0, heat_cap_ex))
+        temp_eh = np.clip(temp_eh, -25.0, 50.0)
+
+        temp_su = np.where(flow_su == 0.0, signal(op_data, "temp_rm", size),
+                           temp + (hrec_pwr + htg_pwr - clg_pwr) / np.where(flow_su == 0.0, 1.0, heat_cap_su))
+        temp_su = np.clip(temp_su, -25.0, 50.0)
+
+        # CALCULATION OF DUST DEPOSIT AND RESULTING FILTER PRESSURE DROP
+        dust_depo = signal(op_data, "dust_depo", size) + dust_increase_array(signal(op_data, "dust", size),
+                                                                             signal(op_data, "flow_su", size),
+                                                                             signal(op_data, "ti_diff", size))
+        filt_su_pres = filter_curve_array(dust_depo, speed_su)
+        filt_ex_pres = filter_curve_array(dust_depo, speed_ex)
+        return {"flow_su": flow_su, "flow_ex": flow_ex, "temp_su": temp_su, "temp_eh": temp_eh, "hrec_pwr": hrec_pwr,
+                "htg_pwr": htg_pwr, "clg_pwr": clg_pwr, "dust_depo": dust_depo, "filt_su_pres": filt_su_pres,
+                "filt_ex_pres": filt_ex_pres}
@@ -0,0 +1,209 @@
+# packages
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+
+# defs
+# Quantiles reported for every phase, over the rolling window of the latest samples.
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+# Nearest-rank quantile of already sorted values.
+def quantile(values: list, share: float) -> float:
+    if len(values) == 0:
+        return float("nan")
+    index = int(share * len(values) + 0.5) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+# Timing of one phase, used as: with metrics.phase("read_json"): ...
+# or, when the phase doesn't fit in a block: timer = metrics.phase("tick").start() ... timer.stop()
+class PhaseTimer(object):
+    def __init__(self, metrics, name: str, site: str):
+        self.__metrics = metrics
+        self.__name = name
+        self.__site = site
+        self.__start = 0.0
+
+    def start(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def stop(self) -> float:
+        seconds = time.perf_counter() - self.__start
+        self.__metrics.observe(self.__name, seconds, self.__site)
+        return seconds
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+# Latency of the phases of a tick (ambient, read_json, building, calculate, write, persistence, ...) and counters of
+# the communication errors by their codes (get_rd_tout, get_wr_conn, get_fcst_404, ...). Durations are measured with
+# the wall clock even in the scaled and fast clock modes, because they describe the real work done in the tick.
+# Every phase keeps the latest `window` samples, so p50/p95/p99/max follow the recent behaviour, and all-time
+# count and sum. Phases can be labeled with the site, which shows which controller eats the tick budget.
+#
+# Metrics are exported as Prometheus text - into a file (e.g. for the node_exporter textfile collector) and/or from
+# an HTTP endpoint on localhost. Recording is thread safe, the driver's pool and the fetcher use it at once.
+class Metrics(object):
+    def __init__(self, window=1000, prefix="climasim"):
+        self.__window = window
+        self.__prefix = prefix
+        self.__lock = threading.Lock()
+        self.__phases = {}   # (phase, site) -> {"samples": deque, "count": int, "sum": float}
+        self.__errors = {}   # code -> count
+        self.__deferrals = {}   # job -> count
+        self.__breakers = {}   # (endpoint, site) -> state number (0 closed, 1 open, 2 half-open)
+        self.__server = None
+
+    @property
+    def errors(self):
+        return self.__errors
+
+    @property
+    def deferrals(self):
+        return self.__deferrals
+
+    @property
+    def breakers(self):
+        return self.__breakers
+
+    def phase(self, name: str, site="") -> PhaseTimer:
+        return PhaseTimer(self, name, site)
+
+    def observe(self, name: str, seconds: float, site="") -> bool:
+        with self.__lock:
+            phase = self.__phases.get((name, site))
+            if phase is None:
+                phase = {"samples": deque(maxlen=self.__window), "count": 0, "sum": 0.0}
+                self.__phases.update({(name, site): phase})
+            phase["samples"].append(seconds)
+            phase["count"] = phase["count"] + 1
+            phase["sum"] = phase["sum"] + seconds
+        return True
+
+    # "NONE" is the code of success, it's not counted.
+    def count_error(self, code: str) -> bool:
+        if code == "NONE":
+            return False
+        with self.__lock:
+            self.__errors.update({code: self.__errors.get(code, 0) + 1})
+        return True
+
+    # Low priority jobs, which were moved to a later tick, because the current one was running out of time.
+    def count_deferral(self, job: str) -> bool:
+        with self.__lock:
+            self.__deferrals.update({job: self.__deferrals.get(job, 0) + 1})
+        return True
+
+    # Sites sharing a host (e.g. controllers behind one gateway) have their own breakers, so they're told apart by
+    # the site label.
+    def set_breaker_state(self, endpoint: str, state: int, site="") -> bool:
+        with self.__lock:
+            self.__breakers.update({(endpoint, site): state})
+        return True
+
+    # {(phase, site): {"count", "sum", "p50", "p95", "p99", "max"}} - quantiles and max over the window.
+    def summary(self) -> dict:
+        with self.__lock:
+            phases = {key: (sorted(self.__phases[key]["samples"]), self.__phases[key]["count"],
+                            self.__phases[key]["sum"]) for key in self.__phases}
+        summary = {}
+        for key in phases:
+            samples, count, total = phases[key]
+            stats = {"count": count, "sum": total}
+            for share in QUANTILES:
+                stats.update({"p{}".format(int(share * 100)): quantile(samples, share)})
+            stats.update({"max": samples[-1] if len(samples) > 0 else float("nan")})
+            summary.update({key: stats})
+        return summary
+
+    def prometheus_text(self) -> str:
+        summary = self.summary()
+        with self.__lock:
+            errors = dict(self.__errors)
+            deferrals = dict(self.__deferrals)
+            breakers = dict(self.__breakers)
+        lines = ["# HELP {}_phase_seconds Duration of the phases of a tick, quantiles over the last {} samples."
+                 .format(self.__prefix, self.__window),
+                 "# TYPE {}_phase_seconds summary".format(self.__prefix)]
+        for name, site in sorted(summary):
+            stats = summary[(name, site)]
+            labels = 'phase="{}"'.format(name) + (',site="{}"'.format(site) if site != "" else "")
+            for share in QUANTILES:
+                lines.append('{}_phase_seconds{{{},quantile="{}"}} {:.6f}'.format(
+                    self.__prefix, labels, share, stats["p{}".format(int(share * 100))]))
+            lines.append("{}_phase_seconds_sum{{{}}} {:.6f}".format(self.__prefix, labels, stats["sum"]))
+            lines.append("{}_phase_seconds_count{{{}}} {}".format(self.__prefix, labels, stats["count"]))
+        lines.append("# HELP {}_phase_max_seconds Longest duration of the phase over the last {} samples."
+                     .format(self.__prefix, self.__window))
+        lines.append("# TYPE {}_phase_max_seconds gauge".format(self.__prefix))
+        for name, site in sorted(summary):
+            labels = 'phase="{}"'.format(name) + (',site="{}"'.format(site) if site != "" else "")
+            lines.append("{}_phase_max_seconds{{{}}} {:.6f}".format(self.__prefix, labels,
+                                                                   summary[(name, site)]["max"]))
+        lines.append("# HELP {}_errors_total Communication errors by their code.".format(self.__prefix))
+        lines.append("# TYPE {}_errors_total counter".format(self.__prefix))
+        for code in sorted(errors):
+            lines.append('{}_errors_total{{code="{}"}} {}'.format(self.__prefix, code, errors[code]))
+        lines.append("# HELP {}_deferrals_total Periodic jobs deferred to a later tick.".format(self.__prefix))
+        lines.append("# TYPE {}_deferrals_total counter".format(self.__prefix))
+        for job in sorted(deferrals):
+            lines.append('{}_deferrals_total{{job="{}"}} {}'.format(self.__prefix, job, deferrals[job]))
+        lines.append("# HELP {}_breaker_state Circuit breakers of the endpoints: 0 closed, 1 open, 2 half-open."
+                     .format(self.__prefix))
+        lines.append("# TYPE {}_breaker_state gauge".format(self.__prefix))
+        for endpoint, site in sorted(breakers):
+            labels = 'endpoint="{}"'.format(endpoint) + (',site="{}"'.format(site) if site != "" else "")
+            lines.append("{}_breaker_state{{{}}} {}".format(self.__prefix, labels, breakers[(endpoint, site)]))
+        return "\n".join(lines) + "\n"
+
+    # Written atomically, so a collector never reads a half written file.
+    def write(self, file_path: str) -> bool:
+        temp_path = file_path + ".tmp"
+        metrics_file = open(temp_path, mode="w")
+        metrics_file.write(self.prometheus_text())
+        metrics_file.close()
+        os.replace(temp_path, file_path)
+        return True
+
+    # Prometheus endpoint, e.g. http://127.0.0.1:9108/metrics, served from a daemon thread.
+    def serve(self, port: int, host="127.0.0.1") -> bool:
+        if self.__server is not None:
+            return False
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass   # Scrapes are not printed among the simulator's output.
+
+        self.__server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        threading.Thread(target=self.__server.serve_forever, name="metrics", daemon=True).start()
+        return True
+
+    def close(self) -> bool:
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+        return True
+
+
+# Metrics of the whole process, shared by the models (for the error counters) and the simulator loop.
+metrics = Metrics()
@@ -0,0 +1,120 @@
+# defs
+# Fields of the simulation state and their types. Floats are physical values, bools are on/off commands, ints are
+# fan steps. The list covers both building models - a field which isn't used by the running simulator is simply
+# never set, so it stays unavailable.
+FIELDS = (("temp", float), ("preci", float), ("solar", float), ("dust", float), ("ti_diff", float),
+          ("temp_su", float), ("temp_rm", float), ("temp_con", float), ("temp_wall", float), ("temp_ins", float),
+          ("temp_ex", float), ("temp_eh", float),
+          ("air_AQ", float), ("air_PB", float), ("wall_AQ", float), ("wall_PB", float), ("ins_AQ", float),
+          ("ins_PB", float),
+          ("damp_cmd", bool), ("fan_su_cmd", int), ("fan_su_pos", float), ("fan_ex_cmd", int), ("fan_ex_pos", float),
+          ("flow_su", float), ("flow_ex", float), ("hrec_pos", float), ("hrec_pwr", float), ("pump_cmd", bool),
+          ("htg_pos", float), ("htg_pwr", float), ("clg_cmd", bool), ("clg_pos", float), ("clg_pwr", float),
+          ("dust_depo", float), ("filt_su_pres", float), ("filt_ex_pres", float), ("air_q", float),
+          ("error", str))
+FIELD_NAMES = tuple(name for name, field_type in FIELDS)
+FIELD_TYPES = dict(FIELDS)
+# Accepted forms of the bools - as written in op_data.txt and the dumps, and as the controllers send them.
+BOOL_VALUES = {True: True, False: False, 1: True, 0: False, "True": True, "False": False, "1": True, "0": False}
+
+
+# bool() would take any non-empty text, "False" included, as True. Anything unexpected raises ValueError instead.
+def parse_bool(value) -> bool:
+    try:
+        return BOOL_VALUES[value]
+    except (KeyError, TypeError):
+        raise ValueError("Not a bool: {!r}".format(value))
+
+
+CONVERTERS = {name: parse_bool if field_type == bool else field_type for name, field_type in FIELDS}
+
+
+# State of one simulated AHU and building, replacing the plain op_data dict. Every field is a slot with a fixed
+# type. A slot which holds no value is the availability flag - "the controller didn't deliver htg_pos" means the
+# htg_pos slot is empty, not that a key is missing. Models read and write the fields directly (op_data.htg_pos) and
+# check op_data.available("htg_pos"), without any dict lookups or merges.
+#
+# The object still behaves like the old dict (op_data["key"], "key" in op_data, keys(), update(), pop(), ...), where
+# unavailable fields look like missing keys. So the text formats (op_data.txt, dumps), the recorder, the database and
+# the checkpoints work with it unchanged. Keys outside FIELDS (e.g. extra points added to climatix_data.txt) are
+# kept aside in a small dict.
+class OpData(object):
+    __slots__ = FIELD_NAMES + ("__extra",)
+
+    def __init__(self, values=None):
+        self.__extra = {}
+        if values is not None:
+            self.update(values)
+
+    def available(self, key: str) -> bool:
+        if key in FIELD_TYPES:
+            return hasattr(self, key)
+        return key in self.__extra
+
+    # Values which can't be converted to the field type (unexpected content from the controller) leave the field
+    # unavailable, so the models treat them the same way as a missing signal.
+    def __setitem__(self, key: str, value):
+        if key in FIELD_TYPES:
+            try:
+                setattr(self, key, CONVERTERS[key](value))
+            except (TypeError, ValueError):
+                if hasattr(self, key):
+                    delattr(self, key)
+        else:
+            self.__extra[key] = value
+
+    def __getitem__(self, key: str):
+        if key in FIELD_TYPES:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self.__extra[key]
+
+    def __delitem__(self, key: str):
+        if key in FIELD_TYPES:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            del self.__extra[key]
+
+    def __contains__(self, key) -> bool:
+        return self.available(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def keys(self) -> list:
+        return [name for name in FIELD_NAMES if hasattr(self, name)] + list(self.__extra.keys())
+
+    def items(self) -> list:
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key: str, default=None):
+        if self.available(key):
+            return self[key]
+        return default
+
+    def pop(self, key: str, *default):
+        if self.available(key):
+            value = self[key]
+            del self[key]
+            return value
+        if len(default) > 0:
+            return default[0]
+        raise KeyError(key)
+
+    def update(self, values: dict):
+        for key in values:
+            self[key] = values[key]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self):
+        return "OpData({})".format(self.to_dict())
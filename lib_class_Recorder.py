@@ -0,0 +1,229 @@
+# packages
+from array import array
+import glob
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from lib_class_OpData import FIELDS
+from lib_class_other import Clock
+
+
+# defs
+# Binary columnar recording of operating data. The file starts with a header (magic, JSON schema) and then follows
+# a sequence of chunks. Each chunk holds a fixed number of rows, stored column after column, so the data of one
+# channel is a contiguous block of numbers. Uncompressed chunks can be memory-mapped directly by the reader.
+#
+# header: b"CSREC01\n" | schema length (uint32) | schema (JSON, with the format version)
+# chunk:  b"CHNK" | rows (uint32) | payload length (uint32) | compressed flag (uint32) | codes length (uint32) |
+#         codes (JSON) | payload
+# Version 1 chunks have no codes - their header ends with the compressed flag.
+MAGIC = b"CSREC01\n"
+VERSION = 2
+CHUNK_MAGIC = b"CHNK"
+CHUNK_HEADER = struct.Struct("<4sIIII")
+CHUNK_HEADER_1 = struct.Struct("<4sIII")
+
+# Channel types: f8 - 64-bit float, f4 - 32-bit float, u1 - bool stored as a single byte, c2 - text (error codes)
+# stored as 16-bit indices into the chunk's list of codes, 0 meaning no text.
+TYPE_CODES = {"f8": "d", "f4": "f", "u1": "B", "c2": "H"}
+TYPE_SIZES = {"f8": 8, "f4": 4, "u1": 1, "c2": 2}
+
+
+# Schema is declared once, from the static list of the simulation fields (lib_class_OpData.FIELDS) and their types,
+# not from whatever the op_data holds at startup - so a point which the controller didn't deliver on the first read
+# is still recorded for the whole run. Bools are recorded as bools, "error" as a text channel (so its code -
+# get_rd_tout, drv_tout, ... - is kept, as it was in the text dumps) and everything else, the fan steps included,
+# as floats. Unavailable values are recorded as NaN, False for bools and "" for the error.
+def fields_schema(fields=FIELDS) -> list:
+    schema = [["time", "f8"]]
+    for key, field_type in fields:
+        if field_type == bool:
+            schema.append([key, "u1"])
+        elif field_type == str:
+            schema.append([key, "c2"])
+        else:
+            schema.append([key, "f4"])
+    return schema
+
+
+class Recorder(object):
+    def __init__(self, schema: list, file_name="record", chunk_rows=200, compress=False, rotate_bytes=67108864,
+                 rotate_sec=86400.0, clock=None):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
+        self.__schema = schema
+        self.__file_name = file_name
+        self.__chunk_rows = chunk_rows   # 200 rows is 10 minutes of 3-second ticks, that much is lost in a crash.
+        self.__compress = compress
+        self.__rotate_bytes = rotate_bytes
+        self.__rotate_sec = rotate_sec
+        self.__columns = []
+        self.__codes = {}   # Text -> index, for the c2 channels of the current chunk.
+        self.__rows = 0
+        self.__file = None
+        self.__file_path = ""
+        self.__file_started = 0.0
+        self.new_columns()
+
+    @property
+    def schema(self):
+        return self.__schema
+
+    @property
+    def file_path(self):
+        return self.__file_path
+
+    def new_columns(self):
+        self.__columns = [array(TYPE_CODES[channel_type]) for channel, channel_type in self.__schema]
+        self.__codes = {}
+        self.__rows = 0
+
+    def open_file(self):
+        self.__file_started = self.__clock.time()
+        self.__file_path = self.__file_name + self.__clock.strftime("_%y%m%d_%H%M%S") + ".csr"
+        self.__file = open(self.__file_path, mode="wb", buffering=262144)
+        header = json.dumps({"version": VERSION, "channels": self.__schema}).encode("utf-8")
+        self.__file.write(MAGIC)
+        self.__file.write(struct.pack("<I", len(header)))
+        self.__file.write(header)
+        return True
+
+    # This is called on every tick. It only appends numbers to in-memory columns, the file is touched once per chunk.
+    def record(self, op_data: dict) -> bool:
+        for index, (channel, channel_type) in enumerate(self.__schema):
+            if channel == "time":
+                value = self.__clock.time()
+            elif channel_type == "c2":
+                value = 0
+                if channel in op_data and op_data[channel] != "":
+                    value = self.__codes.setdefault(str(op_data[channel]), len(self.__codes) + 1)
+            elif channel in op_data:
+                value = op_data[channel]
+            elif channel_type == "u1":
+                value = 0
+            else:
+                value = float("nan")
+            if channel_type == "u1":
+                value = int(bool(value))
+            self.__columns[index].append(value)
+        self.__rows = self.__rows + 1
+        if self.__rows >= self.__chunk_rows:
+            self.write_chunk()
+        return True
+
+    def write_chunk(self) -> bool:
+        if self.__rows == 0:
+            return False
+        if self.__file is None:
+            self.open_file()
+        payload = b"".join(column.tobytes() for column in self.__columns)
+        if self.__compress:
+            payload = zlib.compress(payload, 6)
+        codes = json.dumps(sorted(self.__codes, key=self.__codes.get)).encode("utf-8")
+        self.__file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self.__rows, len(payload), int(self.__compress), len(codes)))
+        self.__file.write(codes)
+        self.__file.write(payload)
+        self.__file.flush()
+        self.new_columns()
+        # Rotation happens only at chunk boundaries, so every file is complete on its own.
+        if self.__file.tell() >= self.__rotate_bytes or \
+                self.__clock.time() - self.__file_started >= self.__rotate_sec:
+            self.__file.close()
+            self.__file = None
+        return True
+
+    def close(self) -> bool:
+        self.write_chunk()
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        return True
+
+    # Retention of the rotated files, run with the pruning of the store. A file ends where the next one starts, so
+    # it's deleted when the start time in the name of the next file is older than `before`. The newest file, which
+    # may still be open, is always kept. Returns the number of deleted files.
+    def prune(self, before: float) -> int:
+        pattern = glob.escape(self.__file_name) + "_" + "[0-9]" * 6 + "_" + "[0-9]" * 6 + ".csr"
+        file_paths = sorted(glob.glob(pattern))
+        deleted = 0
+        for file_path, next_path in zip(file_paths, file_paths[1:]):
+            if file_path == self.__file_path:
+                continue
+            if time.mktime(time.strptime(next_path[-17:-4], "%y%m%d_%H%M%S")) > before:
+                break
+            try:
+                os.remove(file_path)
+                deleted = deleted + 1
+            except OSError as exception:
+                print("{} ; {}".format({"error": "record_prune"}, exception))
+        return deleted
+
+
+# Reading the recording. Chunks are yielded one by one, as dicts of NumPy arrays - uncompressed ones straight from
+# the memory-mapped file, without copying. NumPy is needed only here, the recording itself works without it.
+def read_chunks(file_path: str, channels=None):
+    import numpy as np
+    record_file = open(file_path, mode="rb")
+    if os.fstat(record_file.fileno()).st_size == 0:
+        record_file.close()
+        return
+    data = mmap.mmap(record_file.fileno(), 0, access=mmap.ACCESS_READ)
+    record_file.close()
+    if data[0:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a recording file: {}".format(file_path))
+    position = len(MAGIC)
+    header_size = struct.unpack_from("<I", data, position)[0]
+    header = json.loads(data[position + 4:position + 4 + header_size].decode("utf-8"))
+    schema = header["channels"]
+    chunk_header = CHUNK_HEADER if header.get("version", 1) >= 2 else CHUNK_HEADER_1
+    position = position + 4 + header_size
+    while position + chunk_header.size <= len(data):
+        codes_size = 0
+        if chunk_header is CHUNK_HEADER:
+            chunk_magic, rows, payload_size, compressed, codes_size = chunk_header.unpack_from(data, position)
+        else:
+            chunk_magic, rows, payload_size, compressed = chunk_header.unpack_from(data, position)
+        position = position + chunk_header.size
+        if chunk_magic != CHUNK_MAGIC or position + codes_size + payload_size > len(data):
+            break   # Truncated tail, e.g. after a crash - everything before it is still good.
+        codes = [""]
+        if codes_size > 0:
+            codes = codes + json.loads(data[position:position + codes_size].decode("utf-8"))
+        position = position + codes_size
+        if compressed:
+            payload = zlib.decompress(data[position:position + payload_size])
+        else:
+            payload = memoryview(data)[position:position + payload_size]
+        chunk = {}
+        offset = 0
+        for channel, channel_type in schema:
+            size = rows * TYPE_SIZES[channel_type]
+            if channels is None or channel in channels:
+                if channel_type == "c2":
+                    column = np.frombuffer(payload, dtype="<u2", count=rows, offset=offset)
+                    column = np.array(codes)[column]   # Texts, "" where there was none.
+                else:
+                    column = np.frombuffer(payload, dtype="<" + channel_type, count=rows, offset=offset)
+                if channel_type == "u1":
+                    column = column.view(bool)
+                chunk.update({channel: column})
+            offset = offset + size
+        position = position + payload_size
+        yield chunk
+
+
+# Whole recording at once, concatenated into one array per channel.
+def load_recording(file_path: str, channels=None) -> dict:
+    import numpy as np
+    parts = {}
+    for chunk in read_chunks(file_path, channels):
+        for channel in chunk:
+            parts.setdefault(channel, []).append(chunk[channel])
+    output = {}
+    for channel in parts:
+        output.update({channel: np.concatenate(parts[channel])})
+    return output
@@ -0,0 +1,86 @@
+# packages
+import numbers
+import time
+from lib_class_other import Clock
+
+
+# defs
+# Aggregation tiers: name and length of the interval [s].
+TIERS = (("minute", 60.0), ("hour", 3600.0), ("day", 86400.0))
+
+
+# Incremental rollups of operating data. Every sample updates the open interval of each tier in constant time -
+# count, min, max, sum (for the mean), last value and the time integral (value * hours, so a power in kW gives
+# energy in kWh). When a sample falls into a newer interval, the old one is closed and handed over to the store.
+# Intervals are aligned to the local time of the clock, so a day runs from local midnight (hours and minutes are
+# the same as in UTC, except for zones with a fractional offset). Nothing is rescanned, so reports can read the
+# rollups instead of the raw data.
+class Rollup(object):
+    def __init__(self, channels: list, store=None, tiers=TIERS, clock=None):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
+        self.__channels = channels
+        self.__store = store
+        self.__tiers = tiers
+        self.__open = {}       # (channel, tier) -> [start, count, min, max, sum, last, integral]
+        self.__previous = {}   # channel -> (time, value) of the previous sample, for the integral
+        self.__closed = []
+
+    @property
+    def channels(self):
+        return self.__channels
+
+    @property
+    def open_intervals(self):
+        return self.__open
+
+    def update(self, op_data: dict) -> bool:
+        now = self.__clock.time()
+        offset = time.localtime(now).tm_gmtoff
+        for channel in self.__channels:
+            if channel not in op_data or not isinstance(op_data[channel], numbers.Real):
+                continue   # missing or not a number (text) - nothing to aggregate
+            value = float(op_data[channel])
+            if value != value:
+                continue   # NaN - value not available
+            increment = 0.0
+            if channel in self.__previous:
+                previous_time, previous_value = self.__previous[channel]
+                increment = previous_value * (now - previous_time) / 3600
+            self.__previous.update({channel: (now, value)})
+            for tier, length in self.__tiers:
+                start = now - (now + offset) % length
+                interval = self.__open.get((channel, tier))
+                if interval is not None and interval[0] != start:
+                    self.__closed.append((channel, tier) + tuple(interval))
+                    interval = None
+                if interval is None:
+                    self.__open.update({(channel, tier): [start, 1, value, value, value, value, increment]})
+                else:
+                    interval[1] = interval[1] + 1
+                    interval[2] = min(interval[2], value)
+                    interval[3] = max(interval[3], value)
+                    interval[4] = interval[4] + value
+                    interval[5] = value
+                    interval[6] = interval[6] + increment
+        if len(self.__closed) > 0 and self.__store is not None:
+            self.__store.append_rollups(self.__closed)
+            self.__closed = []
+        return True
+
+    # Closed intervals not taken by a store. Each row: (channel, tier, start, count, min, max, sum, last, integral).
+    def take_closed(self) -> list:
+        closed = self.__closed
+        self.__closed = []
+        return closed
+
+    # Open intervals are stored as they are. After restart the store merges them with the rest of the interval.
+    def close(self) -> list:
+        for channel, tier in self.__open:
+            self.__closed.append((channel, tier) + tuple(self.__open[(channel, tier)]))
+        self.__open = {}
+        if self.__store is not None:
+            self.__store.append_rollups(self.__closed)
+            self.__closed = []
+        return self.take_closed()
@@ -0,0 +1,147 @@
+# packages
+import math
+from lib_class_Metrics import metrics
+from lib_class_other import Clock
+
+
+# defs
+# Deadline scheduler for the main loop - the only timing of the ticks and the periodic jobs. Ticks are planned on
+# the monotonic simulation clock at start + n * step, so they don't drift with the duration of the ticks and wall
+# clock adjustments don't move them. wait() sleeps once, exactly until the next deadline, and steps can be shorter
+# than a second.
+#
+# When a tick overruns its slot, it's not silently lost - the next wait() reports how late it is and what happened:
+# policy "skip" - the missed deadlines are dropped and the loop continues from the latest one (counted as skipped),
+# policy "catch_up" - every missed tick is run, back to back without sleeping, until the loop is on time again.
+#
+# Periodic jobs (storing op_data every minute, checkpoints, ...) are registered with every(). They're run by
+# run_due() when their deadline has passed - a tick which comes a second late still runs them, and if a job missed
+# several periods, it runs once and the missed periods are counted.
+#
+# The jobs are the low priority, deferrable part of the tick. The critical stages (reading, the model step and writing
+# to the controller) run first, then run_due() gets whatever is left of the step. Every job declares its time budget
+# and a due job which doesn't fit in the remaining time is deferred to the next tick with enough slack, instead of
+# pushing the next control step late. Each deferral is recorded (printed, counted per task and in the metrics). So
+# a job isn't starved by a persistently slow controller, one which is overdue by its whole period runs anyway.
+class Scheduler(object):
+    def __init__(self, step=3.0, policy="skip", tolerance=None, clock=None):
+        if policy not in ("skip", "catch_up"):
+            raise ValueError("Unknown scheduler policy: {}".format(policy))
+        if step <= 0.0:
+            raise ValueError("Scheduler step must be positive, got: {}".format(step))
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
+        self.__step = step
+        self.__policy = policy
+        if tolerance is None:
+            tolerance = step / 10   # A tick which starts later than that is reported as late.
+        self.__tolerance = tolerance
+        self.__started = self.__clock.monotonic()
+        self.__next_deadline = self.__started + step
+        self.__elapsed = 0.0
+        self.__ticks = 0
+        self.__late_ticks = 0
+        self.__skipped_ticks = 0
+        self.__tasks = []
+
+    @property
+    def step(self):
+        return self.__step
+
+    @property
+    def policy(self):
+        return self.__policy
+
+    # Scheduled time since the start [s] of the last tick - not the measured one, so it advances by exact steps.
+    @property
+    def elapsed(self):
+        return self.__elapsed
+
+    @property
+    def tasks(self):
+        return self.__tasks
+
+    def stats(self) -> dict:
+        return {"ticks": self.__ticks, "late_ticks": self.__late_ticks, "skipped_ticks": self.__skipped_ticks,
+                "deferred_jobs": sum(task["deferred"] for task in self.__tasks)}
+
+    # Time left [s] until the next tick is due, negative when the current tick has already overrun its step.
+    def remaining(self) -> float:
+        return self.__next_deadline - self.__clock.monotonic()
+
+    # Elapsed time for checkpoints. After restoring, the schedule continues from there, starting with a tick right away.
+    @property
+    def state(self):
+        return {"elapsed": self.__elapsed}
+
+    @state.setter
+    def state(self, state: dict):
+        now = self.__clock.monotonic()
+        self.__elapsed = state["elapsed"]
+        self.__started = now - self.__elapsed - self.__step
+        self.__next_deadline = now
+        for task in self.__tasks:
+            task["deadline"] = self.__started + math.ceil((now - self.__started) / task["period"]) * task["period"]
+
+    # First deadline of a task with given period, which comes after now. Deadlines are aligned to the start.
+    def next_deadline(self, period: float, now: float) -> float:
+        return self.__started + (math.floor((now - self.__started) / period) + 1) * period
+
+    # The budget [s] is how long the job is expected to take at most. With 0.0 it runs whenever the tick isn't late.
+    def every(self, period: float, job, name="", budget=0.0) -> bool:
+        if period <= 0.0:
+            raise ValueError("Task period must be positive, got: {}".format(period))
+        self.__tasks.append({"name": name, "period": period, "job": job, "budget": budget, "runs": 0, "missed": 0,
+                             "deferred": 0, "deadline": self.next_deadline(period, self.__clock.monotonic())})
+        return True
+
+    # Returns the description of the tick: its number, scheduled elapsed time, how late it started [s] and how many
+    # ticks were skipped right before it.
+    def wait(self) -> dict:
+        deadline = self.__next_deadline
+        now = self.__clock.monotonic()
+        if now < deadline:
+            self.__clock.sleep(deadline - now)
+            now = self.__clock.monotonic()
+        late = now - deadline
+        skipped = 0
+        if late > self.__tolerance:
+            self.__late_ticks = self.__late_ticks + 1
+            if late >= self.__step and self.__policy == "skip":
+                skipped = int(late // self.__step)
+                self.__skipped_ticks = self.__skipped_ticks + skipped
+            print("Tick {} late by {:.3f}s, {} skipped".format(self.__ticks + 1, late, skipped))
+        deadline = deadline + skipped * self.__step
+        late = now - deadline
+        self.__next_deadline = deadline + self.__step
+        self.__elapsed = deadline - self.__started
+        self.__ticks = self.__ticks + 1
+        return {"tick": self.__ticks, "elapsed": self.__elapsed, "late": late, "skipped": skipped}
+
+    # Runs the periodic jobs which are due and fit in the rest of the tick, in the order of registration.
+    # Returns the names of those which ran.
+    def run_due(self) -> list:
+        done = []
+        for task in self.__tasks:
+            now = self.__clock.monotonic()
+            if now < task["deadline"]:
+                continue
+            remaining = self.__next_deadline - now
+            if remaining < task["budget"] or remaining < 0.0:
+                if now - task["deadline"] < task["period"]:
+                    task["deferred"] = task["deferred"] + 1
+                    metrics.count_deferral(task["name"])
+                    print("Task {} deferred, {:.3f}s left of the tick, {:.3f}s needed".format(task["name"], remaining,
+                                                                                          task["budget"]))
+                    continue
+                print("Task {} deferred for a whole period, runs anyway".format(task["name"]))
+            missed = int((now - task["deadline"]) // task["period"])
+            if missed > 0:
+                task["missed"] = task["missed"] + missed
+                print("Task {} missed {} period(s)".format(task["name"], missed))
+            task["deadline"] = task["deadline"] + (missed + 1) * task["period"]
+            task["job"]()
+            task["runs"] = task["runs"] + 1
+            done.append(task["name"])
+        return done
@@ -0,0 +1,164 @@
+# packages
+import json
+import numbers
+import sqlite3
+from lib_class_other import Clock
+
+
+# defs
+# Numbers json does not know itself (numpy scalars) are stored as float, anything else as its text.
+def _json_value(value):
+    return float(value) if isinstance(value, numbers.Real) else str(value)
+
+
+# Operating data stored in an embedded SQLite database. The database runs in WAL mode, so several simulators on one
+# host can write into the same file (each one as a separate site) while others read from it.
+# channels - one row per site and channel name
+# samples - time series of every channel, the primary key (channel, time) serves the time-range queries
+# latest - the most recent complete op_data of each site, used for recovery after restart
+# rollups - minute/hour/day aggregates from Rollup, kept for much longer than the raw samples
+# Samples and rollups are only collected in memory on a tick. They're written in one transaction by flush(), which
+# the simulators run as a periodic job with its own time budget, so the database never delays a tick.
+class OpDataStore(object):
+    def __init__(self, db_path="op_data.db", site="default", clock=None):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
+        self.__db_path = db_path
+        self.__site = site
+        self.__connection = sqlite3.connect(db_path, timeout=5.0, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS channels ("
+                                      "id INTEGER PRIMARY KEY, site TEXT NOT NULL, name TEXT NOT NULL, "
+                                      "UNIQUE (site, name))")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS samples ("
+                                      "channel INTEGER NOT NULL, time REAL NOT NULL, value REAL, "
+                                      "PRIMARY KEY (channel, time)) WITHOUT ROWID")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS latest ("
+                                      "site TEXT PRIMARY KEY, time REAL NOT NULL, state TEXT NOT NULL)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS rollups ("
+                                      "channel INTEGER NOT NULL, tier TEXT NOT NULL, start REAL NOT NULL, "
+                                      "count INTEGER, min REAL, max REAL, sum REAL, last REAL, integral REAL, "
+                                      "PRIMARY KEY (channel, tier, start)) WITHOUT ROWID")
+        self.__channels = {}
+        self.__pending = []   # (channel name, time, value) - the channel IDs are looked up by flush().
+        self.__pending_rollups = []
+        self.__last_state = None
+
+    @property
+    def db_path(self):
+        return self.__db_path
+
+    @property
+    def site(self):
+        return self.__site
+
+    @property
+    def connection(self):
+        return self.__connection
+
+    def channel_id(self, name: str) -> int:
+        if name not in self.__channels:
+            with self.__connection:
+                self.__connection.execute("INSERT OR IGNORE INTO channels (site, name) VALUES (?, ?)",
+                                          (self.__site, name))
+            row = self.__connection.execute("SELECT id FROM channels WHERE site = ? AND name = ?",
+                                            (self.__site, name)).fetchone()
+            self.__channels.update({name: row[0]})
+        return self.__channels[name]
+
+    # Called on every tick. Values are only collected here, the database is written by flush(). Only numbers (bools
+    # as 0/1) are samples - texts such as the error code are left out, so a value can never stop the tick.
+    def append(self, op_data: dict) -> bool:
+        now = self.__clock.time()
+        for key in op_data:
+            value = op_data[key]
+            if not isinstance(value, numbers.Real):
+                continue
+            self.__pending.append((key, now, float(value)))
+        self.__last_state = (now, json.dumps(dict(op_data), default=_json_value))
+        return True
+
+    # Closed intervals from Rollup, written with the next batch. An interval which is already in the database (the
+    # part stored before a restart) is merged with the new part.
+    def append_rollups(self, rows: list) -> bool:
+        self.__pending_rollups.extend(rows)
+        return True
+
+    def flush(self) -> bool:
+        if self.__last_state is None and len(self.__pending_rollups) == 0:
+            return False
+        samples = [(self.channel_id(name), time, value) for name, time, value in self.__pending]
+        rollups = [(self.channel_id(row[0]),) + tuple(row[1:]) for row in self.__pending_rollups]
+        with self.__connection:
+            self.__connection.executemany("INSERT OR REPLACE INTO samples (channel, time, value) VALUES (?, ?, ?)",
+                                          samples)
+            self.__connection.executemany("INSERT INTO rollups "
+                                          "(channel, tier, start, count, min, max, sum, last, integral) "
+                                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                                          "ON CONFLICT (channel, tier, start) DO UPDATE SET "
+                                          "count = count + excluded.count, min = min(min, excluded.min), "
+                                          "max = max(max, excluded.max), sum = sum + excluded.sum, "
+                                          "last = excluded.last, integral = integral + excluded.integral",
+                                          rollups)
+            if self.__last_state is not None:
+                self.__connection.execute("INSERT OR REPLACE INTO latest (site, time, state) VALUES (?, ?, ?)",
+                                          (self.__site, self.__last_state[0], self.__last_state[1]))
+        self.__pending = []
+        self.__pending_rollups = []
+        self.__last_state = None
+        return True
+
+    # Retention of raw data - samples older than given time are deleted, the rollups stay.
+    def prune(self, before: float) -> int:
+        with self.__connection:
+            cursor = self.__connection.execute("DELETE FROM samples WHERE time < ? AND channel IN "
+                                               "(SELECT id FROM channels WHERE site = ?)", (before, self.__site))
+        return cursor.rowcount
+
+    # Samples of one channel from the time range [start, end), as a list of (time, value).
+    def query(self, channel: str, start: float, end: float, site=None) -> list:
+        if site is None:
+            site = self.__site
+        return self.__connection.execute("SELECT s.time, s.value FROM samples s JOIN channels c ON s.channel = c.id "
+                                         "WHERE c.site = ? AND c.name = ? AND s.time >= ? AND s.time < ? "
+                                         "ORDER BY s.time", (site, channel, start, end)).fetchall()
+
+    # Aggregates of one channel and tier (minute, hour, day) with the start in [start, end), as a list of dicts.
+    def query_rollups(self, channel: str, tier: str, start: float, end: float, site=None) -> list:
+        if site is None:
+            site = self.__site
+        rows = self.__connection.execute("SELECT r.start, r.count, r.min, r.max, r.sum, r.last, r.integral "
+                                         "FROM rollups r JOIN channels c ON r.channel = c.id "
+                                         "WHERE c.site = ? AND c.name = ? AND r.tier = ? AND r.start >= ? "
+                                         "AND r.start < ? ORDER BY r.start",
+                                         (site, channel, tier, start, end)).fetchall()
+        output = []
+        for row in rows:
+            output.append({"start": row[0], "count": row[1], "min": row[2], "max": row[3], "mean": row[4] / row[1],
+                           "last": row[5], "integral": row[6]})
+        return output
+
+    def latest_state(self, site=None):
+        if site is None:
+            site = self.__site
+        row = self.__connection.execute("SELECT time, state FROM latest WHERE site = ?", (site,)).fetchone()
+        if row is None:
+            return None
+        return {"time": row[0], "op_data": json.loads(row[1])}
+
+    # Same purpose as Handler.recover_op_data, but from the latest row of the database. Errors are not recovered.
+    def recover_op_data(self, op_data: dict) -> dict:
+        latest = self.latest_state()
+        if latest is not None:
+            for key in latest["op_data"]:
+                if key != "error":
+                    op_data.update({key: latest["op_data"][key]})
+        return op_data
+
+    def close(self) -> bool:
+        self.flush()
+        self.__connection.close()
+        return True
@@ -0,0 +1,169 @@
+# packages
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from urllib.parse import urlsplit
+from lib_class_Metrics import metrics
+
+
+# defs
+# States of the circuit breaker, their numbers are exported in the metrics.
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+BREAKER_STATES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+# Endpoints are named by their host, e.g. "10.0.0.21" or "api.meteo.pl", in the logs and in the metrics.
+def endpoint_name(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+# Raised instead of sending a request, while the breaker of the endpoint is open.
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+# Circuit breaker of one endpoint. After `failures` failed requests in a row (timeouts, connection errors, HTTP 5xx)
+# it opens and requests are refused at once, without touching the network. After a delay it lets a single probe
+# through (half-open): when the probe succeeds, the breaker closes again, when it fails, the breaker opens again for
+# twice as long, up to max_delay. The delays are shortened by a random part (jitter), so many sites don't probe
+# a recovering endpoint all at the same moment. Times are real seconds - the outage is real, whatever the clock does.
+# site - name of the site which owns the breaker, it labels the breaker's state in the metrics
+class CircuitBreaker(object):
+    def __init__(self, name: str, failures=3, delay=1.0, max_delay=60.0, jitter=0.5, site=""):
+        self.__name = name
+        self.__site = site
+        self.__failures = failures
+        self.__delay = delay
+        self.__max_delay = max_delay
+        self.__jitter = jitter
+        self.__lock = threading.Lock()
+        self.__state = CLOSED
+        self.__failed = 0   # Failures in a row
+        self.__opened = 0   # Times opened in a row, without a successful probe
+        self.__retry_at = 0.0
+        self.__refused = 0
+        metrics.set_breaker_state(self.__name, BREAKER_STATES[self.__state], self.__site)
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def site(self):
+        return self.__site
+
+    @property
+    def state(self):
+        return self.__state
+
+    def stats(self) -> dict:
+        return {"state": self.__state, "failed": self.__failed, "opened": self.__opened, "refused": self.__refused,
+                "retry_in": max(0.0, self.__retry_at - time.monotonic()) if self.__state == OPEN else 0.0}
+
+    def set_state(self, state: str):
+        if state != self.__state:
+            print("Breaker {}{}: {} -> {}".format(self.__name, " ({})".format(self.__site) if self.__site != "" else "",
+                                                  self.__state, state))
+            self.__state = state
+            metrics.set_breaker_state(self.__name, BREAKER_STATES[state], self.__site)
+
+    # Whether a request may be sent now. In the half-open state only one probe is in flight at a time.
+    def allow(self) -> bool:
+        with self.__lock:
+            if self.__state == OPEN and time.monotonic() >= self.__retry_at:
+                self.set_state(HALF_OPEN)
+                return True
+            if self.__state == CLOSED:
+                return True
+            self.__refused = self.__refused + 1
+            return False
+
+    def success(self):
+        with self.__lock:
+            self.__failed = 0
+            self.__opened = 0
+            self.set_state(CLOSED)
+
+    def failure(self):
+        with self.__lock:
+            self.__failed = self.__failed + 1
+            if self.__state == HALF_OPEN or self.__failed >= self.__failures:
+                self.__opened = self.__opened + 1
+                delay = min(self.__max_delay, self.__delay * 2 ** (self.__opened - 1))
+                self.__retry_at = time.monotonic() + delay * (1.0 - self.__jitter * random.random())
+                self.set_state(OPEN)
+
+
+# Persistent HTTP transport for one endpoint (one controller or one API). The session keeps its TCP connections
+# alive between the requests, so the connection setup and the auth handshake are done once, not on every tick.
+# pool_connections - how many different hosts are kept in the pool
+# pool_maxsize - how many connections to a single host are kept open (more than one only makes sense when the
+#                transport is used from several threads at once)
+# breaker - optional CircuitBreaker, with it an unreachable endpoint costs nothing until it's probed again
+#           (requests raise CircuitOpenError meanwhile)
+class Transport(object):
+    def __init__(self, pool_connections=1, pool_maxsize=1, auth=None, headers=None, breaker=None):
+        self.__session = requests.Session()
+        self.__adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.__session.mount("http://", self.__adapter)
+        self.__session.mount("https://", self.__adapter)
+        if auth is not None:
+            self.__session.auth = auth
+        if headers is not None:
+            self.__session.headers.update(headers)
+        self.__breaker = breaker
+
+    @property
+    def session(self):
+        return self.__session
+
+    @property
+    def breaker(self):
+        return self.__breaker
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs):
+        if self.__breaker is None:
+            return self.__session.request(method, url, **kwargs)
+        if not self.__breaker.allow():
+            raise CircuitOpenError("Circuit breaker of {} is open".format(self.__breaker.name))
+        try:
+            response = self.__session.request(method, url, **kwargs)
+        except Exception:
+            self.__breaker.failure()   # Also anything unexpected, so that a half-open breaker isn't left hanging.
+            raise
+        if response.status_code >= 500:
+            self.__breaker.failure()
+        else:
+            self.__breaker.success()   # Even 4xx means the endpoint is up and answering.
+        return response
+
+    # Counters of the connection pools. Each request either reuses an open connection or opens a new one.
+    def stats(self) -> dict:
+        requests_sent = 0
+        new_connections = 0
+        pools = self.__adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent = requests_sent + pool.num_requests
+                new_connections = new_connections + pool.num_connections
+        stats = {"requests": requests_sent,
+                 "new_connections": new_connections,
+                 "reused_connections": requests_sent - new_connections}
+        if self.__breaker is not None:
+            stats.update({"breaker": self.__breaker.stats()})
+        return stats
+
+    def close(self):
+        self.__session.close()
+        return True
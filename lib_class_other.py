@@ -1,34 +1,95 @@
 # packages
 # import requests
 # from datetime import datetime
+import os
 import time
 
 
 # defs
+# Simulation clock, shared by all the models and by the main loop. Every piece of code which needs to know "what time
+# is it" should ask the clock instead of the time module - this way the whole simulation can be fast-forwarded.
+# Mode "real": ordinary wall clock, exactly as it used to be.
+# Mode "scaled": simulated time runs "scale" times faster than the wall clock, e.g. 60x means 1 hour per minute.
+# Mode "fast": simulated time moves only when somebody sleeps, so the loop runs as fast as the CPU allows.
+class Clock(object):
+    def __init__(self, mode="real", scale=1.0, start=None):
+        if mode not in ("real", "scaled", "fast"):
+            raise ValueError("Unknown clock mode: {}".format(mode))
+        if scale <= 0.0:
+            raise ValueError("Clock scale must be positive, got: {}".format(scale))
+        self.__mode = mode
+        self.__scale = scale
+        self.__real_started = time.time()
+        self.__monotonic_started = time.monotonic()
+        if start is None:
+            self.__sim_started = self.__real_started
+        else:
+            self.__sim_started = start
+        self.__sim_elapsed = 0.0   # Used only in "fast" mode, accumulated by sleep() calls.
+
+    @property
+    def mode(self):
+        return self.__mode
+
+    @property
+    def scale(self):
+        return self.__scale
+
+    def time(self) -> float:
+        if self.__mode == "real":
+            return time.time()
+        elif self.__mode == "scaled":
+            return self.__sim_started + (time.time() - self.__real_started) * self.__scale
+        else:
+            return self.__sim_started + self.__sim_elapsed
+
+    # Simulated seconds which never go back, not even when the system clock is adjusted. Only differences between
+    # two readings make sense, it's meant for scheduling.
+    def monotonic(self) -> float:
+        if self.__mode == "real":
+            return time.monotonic()
+        elif self.__mode == "scaled":
+            return (time.monotonic() - self.__monotonic_started) * self.__scale
+        else:
+            return self.__sim_elapsed
+
+    def sleep(self, seconds: float):
+        if seconds <= 0.0:
+            return
+        if self.__mode == "real":
+            time.sleep(seconds)
+        elif self.__mode == "scaled":
+            time.sleep(seconds / self.__scale)
+        else:
+            self.__sim_elapsed = self.__sim_elapsed + seconds
+
+    def localtime(self):
+        return time.localtime(self.time())
+
+    def strftime(self, time_format: str) -> str:
+        return time.strftime(time_format, self.localtime())
+
+
 class Handler(object):
-    def __init__(self, op_data_path="op_data.txt", dump_file_name="dump"):
+    def __init__(self, op_data_path="op_data.txt", dump_file_name="dump", clock=None):
+        if clock is None:
+            clock = Clock()
+        self.__clock = clock
         self.__op_data_path = op_data_path
-        self.__timestamp = time.strftime("_%y%m%d_%H%M")
+        self.__timestamp = self.__clock.strftime("_%y%m%d_%H%M")
         self.__dump_file_path = dump_file_name + self.__timestamp + ".txt"
-        self.__script_started = time.time()
-        self.__total_sec = 0
-        self.__store_sec = 0
-        self.__curr_time = time.time()
-        self.__last_time = time.time()
-
-    def timer(self, step=2):
-        trig = False
-        self.__total_sec = int(time.time() - self.__script_started)
-        if self.__total_sec > self.__store_sec:
-            trig = (self.__total_sec % step == 0)
-        if trig:
-            self.__store_sec = self.__total_sec
-        elapsed_sec = self.__total_sec % 3600
-        elapsed_hrs = self.__total_sec // 3600
-        return trig, elapsed_hrs, elapsed_sec
+        self.__curr_time = self.__clock.time()
+        self.__last_time = self.__clock.time()
+
+    @property
+    def clock(self):
+        return self.__clock
 
+    # Time since the previous call [h]. The ticks and the elapsed time are planned by the Scheduler (and checkpointed
+    # with it), this only measures the step of the models. It starts counting when the Handler is created, so the
+    # first step after a restart doesn't include the time the script was down.
     def ti_diff(self):
-        self.__curr_time = time.time()
+        self.__curr_time = self.__clock.time()
         ti_diff = (self.__curr_time - self.__last_time) / 3600
         self.__last_time = self.__curr_time
         return ti_diff
@@ -73,7 +134,7 @@ class Handler(object):
 
     def dump_to_file(self, op_data: dict):
         report_file = open(self.__dump_file_path, mode="a")
-        line = "{}".format(time.strftime("%Y.%m.%d %H:%M"))
+        line = "{}".format(self.__clock.strftime("%Y.%m.%d %H:%M"))
         for key in op_data:
             if op_data[key] in (True, False):
                 line = line + ";{}={}".format(key, op_data[key])
@@ -87,11 +148,20 @@ class Handler(object):
         return True
 
 
-def load_config(config_path: str) -> dict:
-    config_file = open(config_path, mode="r")
+def load_config(config_path: str, defaults=None) -> dict:
+    # When defaults are given, the config file becomes optional - values from the file override the defaults
+    # and a missing file simply means "use the defaults". Without defaults, the file is mandatory as always.
+    config = {}
+    if defaults is not None:
+        config.update(defaults)
+        try:
+            config_file = open(config_path, mode="r")
+        except FileNotFoundError:
+            return config
+    else:
+        config_file = open(config_path, mode="r")
     config_data = config_file.readlines()
     config_file.close()
-    config = {}
     for line in config_data:
         marker = line.find("=")   # It finds the first occurence of "=" character
         key = line[0:marker]   # What's before that marker, will become a key and what follows after, will be a value.
@@ -104,3 +174,91 @@ def load_config(config_path: str) -> dict:
             value = line[(marker + 1):].rstrip("\n")
         config.update({key: value})    # Finally, the "config" dictionary is updated with new entry.
     return config
+
+
+# Checks that all the keys needed by a model are in its config and hold numbers (keys) or texts (text), so a broken
+# config file is reported once, with all its problems, when the model is set up - not as a KeyError in the middle
+# of the run.
+def check_config(config: dict, keys, config_path="", positive=(), text=()) -> bool:
+    problems = []
+    for key in keys:
+        if key not in config.keys():
+            problems.append("{} is missing".format(key))
+        elif type(config[key]) not in (int, float):
+            problems.append("{} is not a number ({}), numbers are given in brackets".format(key, config[key]))
+        elif key in positive and config[key] <= 0.0:
+            problems.append("{} must be greater than 0".format(key))
+    for key in text:
+        if key not in config.keys():
+            problems.append("{} is missing".format(key))
+        elif type(config[key]) != str:
+            problems.append("{} is not a text ({}), it's given without brackets".format(key, config[key]))
+    if len(problems) > 0:
+        raise ValueError("{}: {}".format(config_path, "; ".join(problems)))
+    return True
+
+
+# Keys whose values differ between two configs, including the keys which were added or removed.
+def changed_keys(old_config: dict, new_config: dict) -> set:
+    changed = set()
+    for key in set(old_config.keys()) | set(new_config.keys()):
+        if old_config.get(key) != new_config.get(key):
+            changed.add(key)
+    return changed
+
+
+# Watcher of the config files of running models. Every model with config_path and config attributes can be watched.
+# The main loop calls check() between ticks; when a file's modification time changes, the file is parsed, validated
+# and assigned to the model's config in one step - so a tick sees either the old config or the new one, never a mix.
+# A file which can't be parsed, fails validation or is refused by the model's setter is reported and the model keeps
+# (or gets back) its old config. The models decide themselves (in their config setters) what has to be recomputed,
+# based on which keys have actually changed.
+# Files are polled at most once per period of real time, whatever the simulation clock does.
+class ConfigWatcher(object):
+    def __init__(self, period=5.0):
+        self.__period = period
+        self.__next_check = 0.0
+        self.__watched = []
+
+    @property
+    def watched(self):
+        return self.__watched
+
+    # validate(config, config_path) should raise ValueError for a config which can't be used.
+    def watch(self, model, validate=None) -> bool:
+        self.__watched.append({"model": model, "validate": validate, "mtime": self.mtime(model.config_path)})
+        return True
+
+    @staticmethod
+    def mtime(config_path: str):
+        try:
+            return os.stat(config_path).st_mtime_ns
+        except OSError:
+            return None
+
+    # Returns the list of config files which were reloaded.
+    def check(self) -> list:
+        reloaded = []
+        if time.monotonic() < self.__next_check:
+            return reloaded
+        self.__next_check = time.monotonic() + self.__period
+        for entry in self.__watched:
+            model = entry["model"]
+            mtime = self.mtime(model.config_path)
+            if mtime is None or mtime == entry["mtime"]:
+                continue
+            entry["mtime"] = mtime
+            old_config = model.config
+            try:
+                config = load_config(model.config_path)
+                if entry["validate"] is not None:
+                    entry["validate"](config, model.config_path)
+                model.config = config
+            except (OSError, ValueError, IndexError, KeyError, TypeError, ZeroDivisionError) as exception:
+                print("Config {} not reloaded: {}".format(model.config_path, exception))
+                if model.config is not old_config:
+                    model.config = old_config   # The setter failed halfway, the old config is set up again.
+                continue
+            reloaded.append(model.config_path)
+            print("Config {} reloaded".format(model.config_path))
+        return reloaded
@@ -1,159 +1,253 @@
 # packages
-from lib_class_Ambient import Ambient
-from lib_class_Building import BuildingEx
-from lib_class_Climatix import Climatix
-from lib_class_other import Handler, load_config
-import time
+from lib_class_Ambient import Ambient, AmbientFetcher, check_ambient_config
+from lib_class_Building import BuildingEx, check_buildingex_config
+from lib_class_Checkpoint import Checkpoint
+from lib_class_Climatix import Climatix, check_climatix_config
+from lib_class_Metrics import metrics
+from lib_class_OpData import OpData
+from lib_class_other import Clock, ConfigWatcher, Handler, load_config
+from lib_class_Recorder import Recorder, fields_schema
+from lib_class_Rollup import Rollup
+from lib_class_Scheduler import Scheduler
+from lib_class_Store import OpDataStore
+# import time
 
 
 # defs
-# Future plan: use database to store operating data, instead of using global variable.
-op_data = {"temp": 10.0,
-           "preci": 0.0,
-           "solar": 0.0,
-           "dust": 0.0,
-           "ti_diff": 0.0,
-           "temp_su": 20.0,
-           "temp_rm": 20.0,
-           "temp_wall": 18.0,
-           "temp_ins": 16.0,
-           "temp_ex": 20.0,
-           "temp_eh": 5.5,
-           "air_AQ": 1060.0,
-           "air_PB": 0.0,
-           "wall_AQ": 45000,
-           "wall_PB": 0.0,
-           "ins_AQ": 1300.0,
-           "ins_PB": 0.0,
-           "damp_cmd": True,
-           "flow_su": 0.0,
-           "flow_ex": 0.0,
-           "hrec_pos": 0.0,
-           "hrec_pwr": 0.0,
-           "pump_cmd": True,
-           "htg_pos": 0.0,
-           "htg_pwr": 0.0,
-           "clg_cmd": True,
-           "clg_pos": 0.0,
-           "clg_pwr": 0.0,
-           "dust_depo": 0.0,
-           "filt_su_pres": 1.1,
-           "filt_ex_pres": 1.2,
-           "air_q": 456.0}
+# Simulation state, typed and with availability flags (see lib_class_OpData), initialized with these values.
+op_data = OpData({"temp": 10.0,
+                  "preci": 0.0,
+                  "solar": 0.0,
+                  "dust": 0.0,
+                  "ti_diff": 0.0,
+                  "temp_su": 20.0,
+                  "temp_rm": 20.0,
+                  "temp_wall": 18.0,
+                  "temp_ins": 16.0,
+                  "temp_ex": 20.0,
+                  "temp_eh": 5.5,
+                  "air_AQ": 1060.0,
+                  "air_PB": 0.0,
+                  "wall_AQ": 45000,
+                  "wall_PB": 0.0,
+                  "ins_AQ": 1300.0,
+                  "ins_PB": 0.0,
+                  "damp_cmd": True,
+                  "flow_su": 0.0,
+                  "flow_ex": 0.0,
+                  "hrec_pos": 0.0,
+                  "hrec_pwr": 0.0,
+                  "pump_cmd": True,
+                  "htg_pos": 0.0,
+                  "htg_pwr": 0.0,
+                  "clg_cmd": True,
+                  "clg_pos": 0.0,
+                  "clg_pwr": 0.0,
+                  "dust_depo": 0.0,
+                  "filt_su_pres": 1.1,
+                  "filt_ex_pres": 1.2,
+                  "air_q": 456.0})
+
+
+# Periodic job: op_data is stored every minute and the error, which was shown for that minute, is cleared.
+def store_op_data():
+    data_handler.store_op_data(op_data)
+    if "error" in op_data:
+        op_data.pop("error")
+
+
+# Periodic job: raw samples and recording files past the retention are deleted.
+def prune_data():
+    store.prune(clock.time() - sim_config["store_retention_hrs"] * 3600)
+    recorder.prune(clock.time() - sim_config["store_retention_hrs"] * 3600)
 
 
 # const
 # All constants stored in TXT files
+# The simulator's own settings are optional, by default the simulation runs in real time.
+# clock_mode=real   Or "scaled" (simulated time runs clock_scale times faster) or "fast" (as fast as possible).
+# clock_scale=(60)
+# tick_step=(3)   Step of the main loop [s], can be shorter than a second.
+# tick_policy=skip   What to do with ticks missed by an overrun: "skip" them, or "catch_up" by running them at once.
+# forecast_period=(3600)   How often the forecast and the dust measures are renewed in the background [s].
+# dust_period=(600)
+# record_chunk_rows=(200)   Operating data is recorded on every tick, into binary record_*.csr files. It's written
+# record_compress=(0)       in chunks of that many rows, optionally compressed (1), and a new file is started when
+# record_rotate_mb=(64)     the current one reaches given size or age.
+# record_rotate_hrs=(24)
+# store_path=op_data.db   SQLite database of operating data, can be shared by several simulators on one host.
+# store_site=default      Name under which this simulator stores its data.
+# store_batch_ticks=(20)  Samples are written to the database in batches of that many ticks, by a periodic job.
+# rollup_channels=temp_rm,htg_pwr,...   Channels aggregated per minute, hour and day into the database.
+# store_retention_hrs=(168)   Raw samples older than that are deleted from the database, and older recording files
+#                             from the disk, every hour. 0 keeps them all.
+# config_check_period=(5)   How often [s] the config files of the models are checked for changes. A changed file is
+#                           reloaded between ticks, without restarting the simulator.
+# checkpoint_path=checkpoint.bin   Snapshot of op_data and of the models' state, written atomically every
+# checkpoint_period=(15)            checkpoint_period seconds. After a crash the simulation continues from it.
+# metrics_path=metrics.prom   Latency of the phases of a tick (p50/p95/p99/max) and counters of the communication
+# metrics_period=(15)         errors, written in Prometheus text format every metrics_period seconds (empty path
+# metrics_port=(0)            disables it) and, with a port given, served on http://127.0.0.1:<port>/metrics.
+# budget_checkpoint=(0.2)      Declared time budgets [s] of the periodic jobs. The critical stages (read, model step,
+# budget_store_op_data=(0.2)   write) always run. A due job runs only when that much time is left of the tick,
+# budget_store_flush=(0.2)     otherwise it's deferred to the next tick with slack, and the deferral is recorded.
+# budget_prune=(0.5)           The forecast and dust refresh are not in the loop at all, they run in the background.
+# budget_metrics=(0.05)
+sim_config = load_config("simulator_data.txt", {"clock_mode": "real", "clock_scale": 1.0,
+                                                "tick_step": 3.0, "tick_policy": "skip",
+                                                "forecast_period": 3600.0, "dust_period": 600.0,
+                                                "record_chunk_rows": 200.0, "record_compress": 0.0,
+                                                "record_rotate_mb": 64.0, "record_rotate_hrs": 24.0,
+                                                "store_path": "op_data.db", "store_site": "default",
+                                                "store_batch_ticks": 20.0, "store_retention_hrs": 168.0,
+                                                "rollup_channels": "temp_rm,htg_pwr,clg_pwr,hrec_pwr,filt_su_pres,"
+                                                                   "filt_ex_pres,dust_depo,air_q",
+                                                "checkpoint_path": "checkpoint.bin", "checkpoint_period": 15.0,
+                                                "config_check_period": 5.0, "metrics_path": "metrics.prom",
+                                                "metrics_period": 15.0, "metrics_port": 0.0,
+                                                "budget_checkpoint": 0.2, "budget_store_op_data": 0.2,
+                                                "budget_store_flush": 0.2, "budget_prune": 0.5,
+                                                "budget_metrics": 0.05})
 
 
 # code
-ambient = Ambient()
+clock = Clock(sim_config["clock_mode"], sim_config["clock_scale"])
+
+ambient = Ambient(clock=clock)
 ambient.config = load_config(ambient.config_path)
 ambient.create_meteo_headers()
 ambient.get_coordinates()
+ambient.restore_from_cache()   # Valid data from the previous run is used until the fresh one arrives.
+# Forecast and dust measures are renewed in the background, the loop below only reads them from memory.
+fetcher = AmbientFetcher(ambient, sim_config["forecast_period"], sim_config["dust_period"])
+fetcher.start()
 
-controls = Climatix()
+controls = Climatix(clock=clock)
 controls.config = load_config(controls.config_path)
+check_climatix_config(controls.config, controls.config_path)   # A missing or malformed entry stops the script here,
+controls.initialize_params()                                   # not at the first request that needs it.
 controls.climatix_auth()
 # 1st time initialization, to start from good values, not from zeros
-control_values = controls.read_json(["damp_cmd",
-                                     "fan_su_cmd",
-                                     "fan_su_pos",
-                                     "flow_su",
-                                     "fan_ex_cmd",
-                                     "fan_ex_pos",
-                                     "flow_ex",
-                                     "hrec_pos",
-                                     "pump_cmd",
-                                     "htg_pos",
-                                     "clg_cmd",
-                                     "clg_pos",
-                                     "temp",
-                                     "temp_su",
-                                     "temp_rm",
-                                     "air_q"])
-
-for key in control_values:
-    op_data[key] = control_values[key]
-
-data_handler = Handler()
+controls.read_json(["damp_cmd",
+                    "fan_su_cmd",
+                    "fan_su_pos",
+                    "flow_su",
+                    "fan_ex_cmd",
+                    "fan_ex_pos",
+                    "flow_ex",
+                    "hrec_pos",
+                    "pump_cmd",
+                    "htg_pos",
+                    "clg_cmd",
+                    "clg_pos",
+                    "temp",
+                    "temp_su",
+                    "temp_rm",
+                    "air_q"], op_data)
+
+data_handler = Handler(clock=clock)
 op_data = data_handler.recover_op_data(op_data)
-hrs = sec = 0
-
-building = BuildingEx()
+store = OpDataStore(sim_config["store_path"], sim_config["store_site"], clock=clock)
+op_data = store.recover_op_data(op_data)   # The database is more up to date than the op_data file.
+rollup = Rollup(sim_config["rollup_channels"].split(","), store, clock=clock)
+recorder = Recorder(fields_schema(), "record", int(sim_config["record_chunk_rows"]),
+                    sim_config["record_compress"] > 0.0, int(sim_config["record_rotate_mb"] * 1048576),
+                    sim_config["record_rotate_hrs"] * 3600, clock=clock)
+
+building = BuildingEx(clock=clock)
 building.config = load_config(building.config_path)
 building.initialize_params()
 
-while hrs < 168:
-    if (sec % 3600) == 0:
-        ambient.renew_forecast()
-    if (sec % 600) == 0:
-        ambient.renew_dust_measure()
-
-    trig = False
-    while not trig:
-        time.sleep(0.100)
-        trig, hrs, sec = data_handler.timer(3)  # Timer triggers script execution in adjustable steps, 3s for example.
-
+# Ticks and the periodic jobs are planned by the scheduler. Jobs are registered before restoring the checkpoint, so
+# they're aligned with the restored schedule.
+scheduler = Scheduler(sim_config["tick_step"], sim_config["tick_policy"], clock=clock)
+scheduler.every(sim_config["checkpoint_period"], lambda: checkpoint.save(op_data, checkpoint_models), "checkpoint",
+                sim_config["budget_checkpoint"])
+scheduler.every(60.0, store_op_data, "store_op_data", sim_config["budget_store_op_data"])
+scheduler.every(sim_config["store_batch_ticks"] * sim_config["tick_step"], store.flush, "store_flush",
+                sim_config["budget_store_flush"])
+if sim_config["store_retention_hrs"] > 0.0:
+    scheduler.every(3600.0, prune_data, "prune", sim_config["budget_prune"])
+if sim_config["metrics_path"] != "":
+    scheduler.every(sim_config["metrics_period"], lambda: metrics.write(sim_config["metrics_path"]), "metrics",
+                    sim_config["budget_metrics"])
+if sim_config["metrics_port"] > 0.0:
+    metrics.serve(int(sim_config["metrics_port"]))
+
+checkpoint = Checkpoint(sim_config["checkpoint_path"])
+checkpoint_models = {"scheduler": scheduler}
+checkpoint.restore(op_data, checkpoint_models)   # Newer than the op_data file and the database, if present.
+
+watcher = ConfigWatcher(sim_config["config_check_period"])
+watcher.watch(ambient, check_ambient_config)
+watcher.watch(controls, check_climatix_config)
+watcher.watch(building, check_buildingex_config)
+
+while scheduler.elapsed < 168 * 3600:
+    tick = scheduler.wait()   # Sleeps until the next tick is due, late and skipped ticks are reported.
+    hrs, sec = divmod(int(tick["elapsed"]), 3600)
+    watcher.check()   # Changed config files are swapped in here, between ticks.
+
+    tick_timer = metrics.phase("tick").start()   # The whole tick, from waking up to the periodic jobs.
     op_data["ti_diff"] = data_handler.ti_diff()
 
     print("  Elapsed: {}hrs, {}sec, ti_diff: {:.4}, people: ".format(hrs, sec, op_data["ti_diff"] * 3600), end="")
-    outside_conditions = ambient.simulate()
-    for key in ["temp", "preci", "solar", "dust"]:
-        op_data[key] = outside_conditions[key]
-
-    control_values = controls.read_json(["damp_cmd",
-                                         "fan_su_cmd",
-                                         "fan_su_pos",
-                                         "fan_ex_cmd",
-                                         "fan_ex_pos",
-                                         "hrec_pos",
-                                         "pump_cmd",
-                                         "htg_pos",
-                                         "clg_cmd",
-                                         "clg_pos"])
-    for key in control_values:
-        op_data[key] = control_values[key]
-
+    with metrics.phase("ambient"):
+        ambient.simulate(op_data)
+
+    with metrics.phase("read_json"):
+        controls.read_due(["damp_cmd",
+                           "fan_su_cmd",
+                           "fan_su_pos",
+                           "fan_ex_cmd",
+                           "fan_ex_pos",
+                           "hrec_pos",
+                           "pump_cmd",
+                           "htg_pos",
+                           "clg_cmd",
+                           "clg_pos"], op_data)
+
+    building_timer = metrics.phase("building").start()   # All the layers together, each of them on its own below.
     power_source = building.power_delivery(op_data)
 
-    air_conditions = building.calculate_layer("air", op_data, power_source, op_data["temp_wall"])
-    op_data["air_AQ"] = air_conditions["AQ"]
-    op_data["air_PB"] = air_conditions["PB"]
-    op_data["temp_rm"] = op_data["temp_ex"] = air_conditions["temperature"]
-
-    wall_conditions = building.calculate_layer("wall", op_data, air_conditions["power_sink"], op_data["temp_ins"])
-    op_data["wall_AQ"] = wall_conditions["AQ"]
-    op_data["wall_PB"] = wall_conditions["PB"]
-    op_data["temp_wall"] = wall_conditions["temperature"]
-
-    insulation_conditions = building.calculate_layer("ins", op_data, wall_conditions["power_sink"] , op_data["temp"])
-    op_data["ins_AQ"] = insulation_conditions["AQ"]
-    op_data["ins_PB"] = insulation_conditions["PB"]
-    op_data["temp_ins"] = insulation_conditions["temperature"]
+    with metrics.phase("layer_air"):
+        power_sink = building.calculate_layer("air", op_data, power_source, op_data.temp_wall)
+    with metrics.phase("layer_wall"):
+        power_sink = building.calculate_layer("wall", op_data, power_sink, op_data.temp_ins)
+    with metrics.phase("layer_ins"):
+        building.calculate_layer("ins", op_data, power_sink, op_data.temp)
 
-    op_data["air_q"] = building.simulate_dioxide(op_data)
+    building.simulate_dioxide(op_data)
+    building_timer.stop()
 
     print("solar: {:.4}, power_src: {:.6}, temp_rm: {:.4}, temp_wall: {:.4}, temp_ins: {:.4}".
           format(op_data["solar"], power_source, op_data["temp_rm"], op_data["temp_wall"], op_data["temp_ins"]))
 
-    model_values = controls.calculate(op_data)
-    for key in model_values:
-        op_data[key] = model_values[key]
-
-    controls.write_json({"temp": [op_data["temp"], 0],
-                         "temp_su": [op_data["temp_su"], 0],
-                         "temp_rm": [op_data["temp_rm"], 0],
-                         "temp_ex": [op_data["temp_ex"], 0],
-                         "temp_eh": [op_data["temp_eh"], 0],
-                         "flow_su": [op_data["flow_su"], 0],
-                         "flow_ex": [op_data["flow_ex"], 0],
-                         "filt_su_pres": [op_data["filt_su_pres"], 0],
-                         "filt_ex_pres": [op_data["filt_ex_pres"], 0],
-                         "air_q": [op_data["air_q"], 2]})
-
-    if (sec % 60) == 0:
-        data_handler.store_op_data(op_data)
-        data_handler.dump_to_file(op_data)
-        if "error" in op_data.keys():
-            op_data.pop("error")
+    with metrics.phase("calculate"):
+        controls.calculate(op_data)
+
+    with metrics.phase("write_json"):
+        controls.write_changed({"temp": [op_data["temp"], 0],
+                                "temp_su": [op_data["temp_su"], 0],
+                                "temp_rm": [op_data["temp_rm"], 0],
+                                "temp_ex": [op_data["temp_ex"], 0],
+                                "temp_eh": [op_data["temp_eh"], 0],
+                                "flow_su": [op_data["flow_su"], 0],
+                                "flow_ex": [op_data["flow_ex"], 0],
+                                "filt_su_pres": [op_data["filt_su_pres"], 0],
+                                "filt_ex_pres": [op_data["filt_ex_pres"], 0],
+                                "air_q": [op_data["air_q"], 2]})
+
+    with metrics.phase("persist"):
+        recorder.record(op_data)
+        store.append(op_data)
+        rollup.update(op_data)
+
+    with metrics.phase("jobs"):
+        scheduler.run_due()   # Checkpoint, storing op_data, ..., whichever is due and fits in the rest of the tick.
+    tick_timer.stop()
+
+recorder.close()
+rollup.close()
+store.close()
+metrics.close()
@@ -0,0 +1,202 @@
+# packages
+from lib_class_Ambient import Ambient, AmbientFetcher, check_ambient_config, weather_service
+from lib_class_Building import Building, building_params
+from lib_class_Checkpoint import Checkpoint
+from lib_class_Climatix import Climatix, check_climatix_config
+from lib_class_Driver import Driver, climatix_cycle, READ_LIST
+from lib_class_Metrics import metrics
+from lib_class_OpData import OpData
+from lib_class_other import Clock, ConfigWatcher, Handler, load_config
+from lib_class_Recorder import Recorder, fields_schema
+from lib_class_Rollup import Rollup
+from lib_class_Scheduler import Scheduler
+from lib_class_Store import OpDataStore
+
+
+# defs
+# Initial operating data, the same for every site. Each site gets its own OpData state made of it.
+op_data_init = {"temp": 10.0,
+                "preci": 0.0,
+                "solar": 0.0,
+                "dust": 0.0,
+                "ti_diff": 0.0,
+                "temp_su": 20.0,
+                "temp_rm": 20.0,
+                "temp_con": 18.0,
+                "temp_ins": 16.0,
+                "temp_ex": 20.0,
+                "temp_eh": 5.5,
+                "damp_cmd": True,
+                "flow_su": 0.0,
+                "flow_ex": 0.0,
+                "hrec_pos": 0.0,
+                "hrec_pwr": 0.0,
+                "pump_cmd": True,
+                "htg_pos": 0.0,
+                "htg_pwr": 0.0,
+                "clg_cmd": True,
+                "clg_pos": 0.0,
+                "clg_pwr": 0.0,
+                "dust_depo": 0.0,
+                "filt_su_pres": 1.1,
+                "filt_ex_pres": 1.2,
+                "air_q": 456.0}
+
+
+# Periodic jobs, run by the scheduler. Sites whose cycle is still running in the pool are left out this time.
+def idle_sites() -> list:
+    return [name for name in handlers if statuses.get(name, {}).get("error") not in ("drv_busy", "drv_tout")]
+
+
+def store_op_data():
+    for name in idle_sites():
+        op_data = driver.op_data(name)
+        handlers[name].store_op_data(op_data)
+        if "error" in op_data:
+            op_data.pop("error")
+
+
+def save_checkpoints():
+    for name in idle_sites():
+        checkpoints[name][0].save(driver.op_data(name), checkpoints[name][1])
+
+
+def flush_stores():
+    for name in stores:
+        stores[name].flush()
+
+
+def prune_data():
+    for name in stores:
+        stores[name].prune(clock.time() - sim_config["store_retention_hrs"] * 3600)
+        recorders[name].prune(clock.time() - sim_config["store_retention_hrs"] * 3600)
+
+
+# const
+# All constants stored in TXT files
+# sites=north,south,east   Names of the sites. Each site has its own ambient_apis_<name>.txt, climatix_data_<name>.txt
+#                          and building_data_<name>.txt, and its own op_data_<name>.txt, checkpoint_<name>.bin
+#                          and record_<name>_... files.
+#                          Weather is fetched once for all the sites in the same grid cell (or GIOS station).
+# driver_workers=(8)   Size of the thread pool, which runs the controller exchanges at once.
+# driver_timeout=(0)   How long a tick waits for the exchanges [s of real time]. 0 means 5/6 of the tick step, which
+#                      leaves the rest of the tick to the persistence and the periodic jobs.
+# Other settings (clock_mode, clock_scale, tick_step, tick_policy, forecast_period, dust_period, record_...,
+# store_path, store_batch_ticks, checkpoint_period, rollup_channels, store_retention_hrs, config_check_period,
+# metrics_..., budget_...) are the same as for simulator.py. Phases of the cycles are measured per site. The jobs'
+# budgets cover all the sites together.
+# Each site is stored in the database under its own name.
+sim_config = load_config("simulator_data.txt", {"clock_mode": "real", "clock_scale": 1.0, "sites": "",
+                                                "tick_step": 3.0, "tick_policy": "skip",
+                                                "forecast_period": 3600.0, "dust_period": 600.0,
+                                                "record_chunk_rows": 200.0, "record_compress": 0.0,
+                                                "record_rotate_mb": 64.0, "record_rotate_hrs": 24.0,
+                                                "store_path": "op_data.db", "store_batch_ticks": 20.0,
+                                                "store_retention_hrs": 168.0, "checkpoint_period": 15.0,
+                                                "rollup_channels": "temp_rm,htg_pwr,clg_pwr,hrec_pwr,filt_su_pres,"
+                                                                   "filt_ex_pres,dust_depo,air_q",
+                                                "config_check_period": 5.0, "driver_workers": 8.0,
+                                                "driver_timeout": 0.0,
+                                                "metrics_path": "metrics.prom", "metrics_period": 15.0,
+                                                "metrics_port": 0.0, "budget_checkpoint": 0.5,
+                                                "budget_store_op_data": 0.5, "budget_store_flush": 0.5,
+                                                "budget_prune": 1.0, "budget_metrics": 0.05})
+
+
+# code
+clock = Clock(sim_config["clock_mode"], sim_config["clock_scale"])
+
+# The timeout follows the tick step, as it passes in real time (the scaled clock shortens it).
+driver_timeout = sim_config["driver_timeout"]
+if driver_timeout <= 0.0:
+    driver_timeout = sim_config["tick_step"] * 5/6
+    if sim_config["clock_mode"] == "scaled":
+        driver_timeout = driver_timeout / sim_config["clock_scale"]
+driver = Driver(int(sim_config["driver_workers"]), driver_timeout)
+watcher = ConfigWatcher(sim_config["config_check_period"])
+handlers = {}
+recorders = {}
+stores = {}
+rollups = {}
+checkpoints = {}
+for name in sim_config["sites"].split(","):
+    if name == "":
+        continue
+    ambient = Ambient("ambient_apis_{}.txt".format(name), clock=clock, site=name)
+    ambient.config = load_config(ambient.config_path)
+    ambient.create_meteo_headers()
+    weather_service.subscribe(ambient)
+    ambient.restore_from_cache()   # Valid data from the previous run is used until the fresh one arrives.
+    controls = Climatix("climatix_data_{}.txt".format(name), clock=clock, site=name)
+    controls.config = load_config(controls.config_path)
+    check_climatix_config(controls.config, controls.config_path)
+    controls.initialize_params()
+    op_data = OpData(op_data_init)
+    # 1st time initialization, to start from good values, not from zeros
+    controls.read_json(READ_LIST + ["flow_su", "flow_ex", "temp", "temp_su", "temp_rm", "air_q"], op_data)
+    handlers[name] = Handler("op_data_{}.txt".format(name), "dump_{}".format(name), clock=clock)
+    op_data = handlers[name].recover_op_data(op_data)
+    stores[name] = OpDataStore(sim_config["store_path"], name, clock=clock)
+    op_data = stores[name].recover_op_data(op_data)   # The database is more up to date than the op_data file.
+    rollups[name] = Rollup(sim_config["rollup_channels"].split(","), stores[name], clock=clock)
+    recorders[name] = Recorder(fields_schema(), "record_{}".format(name),
+                               int(sim_config["record_chunk_rows"]), sim_config["record_compress"] > 0.0,
+                               int(sim_config["record_rotate_mb"] * 1048576), sim_config["record_rotate_hrs"] * 3600,
+                               clock=clock)
+    building = Building(op_data["temp_rm"], op_data["temp_con"], op_data["temp_ins"],
+                        "building_data_{}.txt".format(name), clock=clock)
+    building.config = load_config(building.config_path)
+    building.initialize_params()
+    checkpoints[name] = (Checkpoint("checkpoint_{}.bin".format(name)), {"building": building})
+    checkpoints[name][0].restore(op_data, checkpoints[name][1])
+    driver.add_site(name, climatix_cycle(controls, building, ambient, name), op_data)
+    watcher.watch(ambient, check_ambient_config)
+    watcher.watch(controls, check_climatix_config)
+    watcher.watch(building, building_params)
+
+# Forecast and dust measures are renewed in the background, the loop below only reads them from memory.
+fetcher = AmbientFetcher(weather_service, sim_config["forecast_period"], sim_config["dust_period"])
+fetcher.start()
+
+scheduler = Scheduler(sim_config["tick_step"], sim_config["tick_policy"], clock=clock)
+scheduler.every(sim_config["checkpoint_period"], save_checkpoints, "checkpoint", sim_config["budget_checkpoint"])
+scheduler.every(60.0, store_op_data, "store_op_data", sim_config["budget_store_op_data"])
+scheduler.every(sim_config["store_batch_ticks"] * sim_config["tick_step"], flush_stores, "store_flush",
+                sim_config["budget_store_flush"])
+if sim_config["store_retention_hrs"] > 0.0:
+    scheduler.every(3600.0, prune_data, "prune", sim_config["budget_prune"])
+if sim_config["metrics_path"] != "":
+    scheduler.every(sim_config["metrics_period"], lambda: metrics.write(sim_config["metrics_path"]), "metrics",
+                    sim_config["budget_metrics"])
+if sim_config["metrics_port"] > 0.0:
+    metrics.serve(int(sim_config["metrics_port"]))
+statuses = {}
+
+# The pool, the files and the database are closed however the loop ends, Ctrl-C included.
+try:
+    while scheduler.elapsed < 168 * 3600:
+        tick = scheduler.wait()   # Sleeps until the next tick is due, late and skipped ticks are reported.
+        hrs, sec = divmod(int(tick["elapsed"]), 3600)
+        watcher.check()   # Changed config files are swapped in here, between ticks.
+
+        tick_timer = metrics.phase("tick").start()   # The whole tick, from waking up to the periodic jobs.
+        with metrics.phase("driver"):
+            statuses = driver.tick({})   # Each site takes the outside conditions from its own Ambient.
+        print("  Elapsed: {}hrs, {}sec, {}".format(hrs, sec, statuses))
+        with metrics.phase("persist"):
+            for name in recorders:
+                if statuses[name]["error"] not in ("drv_busy", "drv_tout"):
+                    recorders[name].record(driver.op_data(name))
+                    stores[name].append(driver.op_data(name))
+                    rollups[name].update(driver.op_data(name))
+
+        with metrics.phase("jobs"):
+            scheduler.run_due()   # Checkpoints, storing op_data, ..., whichever is due and fits in the tick.
+        tick_timer.stop()
+finally:
+    driver.shutdown()
+    for name in recorders:
+        recorders[name].close()
+        rollups[name].close()
+        stores[name].close()
+    metrics.close()
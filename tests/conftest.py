@@ -0,0 +1,5 @@
+# The modules live in the top directory of the repository, next to the simulators.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+# Parity of BuildingExFleet with N scalar BuildingEx models, stepped the same way as simulator_ex.py does it.
+import numpy as np
+from lib_class_Building import BuildingEx
+from lib_class_Fleet import BuildingExFleet
+from lib_class_OpData import OpData
+from lib_class_other import Clock
+
+BUILDINGEX_CONFIG = {"building_D": 20.0, "building_L": 40.0, "building_H": 8.0, "glass_ratio": 0.2,
+                     "glass_capture": 0.6, "concrete_thickness": 0.25, "concrete_density": 2400.0,
+                     "concrete_lambda": 1.7, "concrete_spec_heat": 880.0, "air_thickness": 0.02, "air_density": 1.2,
+                     "air_lambda": 0.025, "air_spec_heat": 1005.0, "styrofoam_thickness": 0.1,
+                     "styrofoam_density": 20.0, "styrofoam_lambda": 0.04, "styrofoam_spec_heat": 1450.0}
+SIZE = 6
+STEPS = 50
+
+
+def scalar_step(building, op_data: OpData):
+    power_source = building.power_delivery(op_data)
+    power_sink = building.calculate_layer("air", op_data, power_source, op_data.temp_wall)
+    power_sink = building.calculate_layer("wall", op_data, power_sink, op_data.temp_ins)
+    building.calculate_layer("ins", op_data, power_sink, op_data.temp)
+    building.simulate_dioxide(op_data)
+    return power_source
+
+
+def test_buildingex_fleet_matches_scalar_models():
+    rng = np.random.default_rng(20)
+    clock = Clock("fast")
+    buildings = []
+    op_data_list = []
+    for index in range(SIZE):
+        config = dict(BUILDINGEX_CONFIG)
+        config["building_L"] = 30.0 + 5.0 * index   # Every building is different.
+        config["styrofoam_thickness"] = 0.05 + 0.02 * index
+        building = BuildingEx(clock=clock)
+        building.config = config
+        building.initialize_params()
+        buildings.append(building)
+        op_data_list.append(OpData({"air_AQ": 5000.0 + 100.0 * index, "air_PB": 0.0, "wall_AQ": 900000.0,
+                                    "wall_PB": 0.0, "ins_AQ": 7000.0, "ins_PB": 0.0, "temp_rm": 20.0, "temp_ex": 20.0,
+                                    "temp_wall": 18.0, "temp_ins": 10.0, "air_q": 600.0 + 150.0 * index}))
+    fleet = BuildingExFleet(buildings, clock=clock)
+    fleet.load_state(op_data_list)
+    for step in range(STEPS):
+        inputs = {"ti_diff": 3.0 / 3600, "temp_su": rng.uniform(15.0, 30.0, SIZE),
+                  "flow_su": rng.uniform(0.0, 7600.0, SIZE), "temp": rng.uniform(-10.0, 30.0, SIZE),
+                  "preci": rng.uniform(0.0, 5.0, SIZE), "solar": rng.uniform(0.0, 800.0, SIZE),
+                  "dust": rng.uniform(0.0, 60.0, SIZE)}
+        scalar_power = []
+        for index in range(SIZE):
+            op_data = op_data_list[index]
+            for key in inputs:
+                op_data[key] = float(np.broadcast_to(inputs[key], (SIZE,))[index])
+            scalar_power.append(scalar_step(buildings[index], op_data))
+        fleet_power = fleet.step(**inputs)
+        np.testing.assert_allclose(fleet_power, scalar_power, rtol=1e-12, atol=1e-9)
+        for key in BuildingExFleet.state_keys:
+            np.testing.assert_allclose(fleet.state[key], [op_data[key] for op_data in op_data_list],
+                                       rtol=1e-12, atol=1e-9, err_msg="{} at step {}".format(key, step))
+        clock.sleep(3.0)
@@ -0,0 +1,55 @@
+# Parity of ClimatixFleet with N scalar Climatix models, including units which miss some of the signals.
+import numpy as np
+from lib_class_Climatix import Climatix
+from lib_class_Fleet import ClimatixFleet
+from lib_class_OpData import OpData
+
+SIZE = 8
+STEPS = 30
+# Signals which a unit may not deliver - missing in the scalar op_data, NaN in the fleet inputs.
+OPTIONAL_KEYS = ("damp_cmd", "fan_su_pos", "fan_su_cmd", "pump_cmd", "htg_pos", "clg_cmd", "clg_pos", "hrec_pos")
+RESULT_KEYS = ("flow_su", "flow_ex", "temp_su", "temp_eh", "hrec_pwr", "htg_pwr", "clg_pwr", "dust_depo",
+               "filt_su_pres", "filt_ex_pres")
+
+
+def random_signals(rng) -> dict:
+    return {"damp_cmd": float(rng.integers(0, 2)), "fan_su_pos": rng.uniform(0.0, 100.0),
+            "fan_su_cmd": float(rng.integers(0, 3)), "pump_cmd": float(rng.integers(0, 2)),
+            "htg_pos": rng.uniform(0.0, 100.0), "clg_cmd": float(rng.integers(0, 2)),
+            "clg_pos": rng.uniform(0.0, 100.0), "hrec_pos": rng.uniform(0.0, 100.0),
+            "temp": rng.uniform(-15.0, 30.0), "temp_ex": rng.uniform(15.0, 25.0), "temp_rm": rng.uniform(18.0, 24.0),
+            "dust": rng.uniform(0.0, 60.0), "ti_diff": 3.0 / 3600}
+
+
+def test_climatix_fleet_matches_scalar_models():
+    rng = np.random.default_rng(3)
+    units = []
+    for index in range(SIZE):
+        unit = Climatix()
+        unit.config = {"ahu_vol": 5000.0 + 500.0 * index, "ahu_spd": 2.0 + 0.1 * index, "ahu_htg": 40.0 + index,
+                       "ahu_clg": 25.0 + index, "hrec_eff": 0.6 + 0.02 * index}
+        unit.initialize_params()
+        units.append(unit)
+    fleet = ClimatixFleet(units)
+    state = [{"flow_su": 0.0, "hrec_pwr": 0.0, "htg_pwr": 0.0, "clg_pwr": 0.0, "dust_depo": 10.0 * index}
+             for index in range(SIZE)]
+    for step in range(STEPS):
+        scalar_inputs = []
+        for index in range(SIZE):
+            signals = random_signals(rng)
+            for key in OPTIONAL_KEYS:
+                if rng.random() < 0.25:
+                    signals.pop(key)
+            signals.update(state[index])
+            scalar_inputs.append(signals)
+        fleet_inputs = {}
+        for key in set(key for signals in scalar_inputs for key in signals):
+            fleet_inputs[key] = np.array([signals.get(key, np.nan) for signals in scalar_inputs])
+        fleet_results = fleet.calculate(fleet_inputs)
+        for index in range(SIZE):
+            op_data = OpData(scalar_inputs[index])
+            units[index].calculate(op_data)
+            for key in RESULT_KEYS:
+                np.testing.assert_allclose(fleet_results[key][index], op_data[key], rtol=1e-12, atol=1e-12,
+                                           err_msg="{} of unit {} at step {}".format(key, index, step))
+            state[index] = {key: op_data[key] for key in ("flow_su", "hrec_pwr", "htg_pwr", "clg_pwr", "dust_depo")}